@@ -2,6 +2,12 @@
 from elasticsearch import Elasticsearch
 import Modules.database as database
 from Modules import process_feedback, topic_preferences_management, rs_logic
+from Modules.job_queue import KeyedJobQueue
+from Modules.user_context import UserContext
+import config.settings
+import itertools
+import threading
+from concurrent.futures import Future
 
 
 # Define database url and credentials
@@ -16,10 +22,16 @@ es = Elasticsearch(
     basic_auth=(username, password)
 )
 
-def getRecommendations(userId):
+# Background jobs that update the user profiles, see getProfileJobs
+profileJobs = None
+profileJobsLock = threading.Lock()
+# Makes the names of commit jobs unique, so that they are never coalesced
+commitJobIds = itertools.count()
+
+def getRecommendations(userId, userContext=None):
     try:
         # Get recommendations
-        recommendations = rs_logic.get_recommendations(userId) 
+        recommendations = rs_logic.get_recommendations(userId, user_context=userContext) 
         return recommendations
     except Exception as e:
         # Log the error for debugging purposes
@@ -35,16 +47,16 @@ def regiserUser(userId, topicIds):
     except Exception as e:
         print(e)
 
-def invokeProcessFeedback(user):
+def invokeProcessFeedback(userContext):
     try:
-        recentFeedbacks = database.findByUserIdAndTimestampGreaterThan(user["userId"],user["feedbackLastUsed"])    
+        recentFeedbacks = database.findByUserIdAndTimestampGreaterThan(userContext.user_id,userContext.get("feedbackLastUsed"))    
         print(recentFeedbacks)
-        print("Invoking model update for User {} with {} Feedbacks".format(user["userId"], len(recentFeedbacks)))
+        print("Invoking model update for User {} with {} Feedbacks".format(userContext.user_id, len(recentFeedbacks)))
         # Log
         print(f'Starting feedback processing with {len(recentFeedbacks)} feedback entries.')
         # Process the feedback data to update the RS model
         try:
-            processing_message = process_feedback.process_feedback(feedback_list=recentFeedbacks)
+            processing_message = process_feedback.process_feedback(feedback_list=recentFeedbacks, user_context=userContext)
 
             if processing_message:
                 
@@ -60,7 +72,7 @@ def invokeProcessFeedback(user):
         print("error while update users")
         print(e)
 
-def invokeUpdateModel(userId):
+def invokeUpdateModel(userId, userContext=None):
     # If userId is wrapped in quotes, strip them
     user_id = userId.strip('"')
     print(f'POST /model with user_id \'{user_id}\'')
@@ -69,11 +81,61 @@ def invokeUpdateModel(userId):
         print ("error: Missing userId in query parameters")
     
     try:
-        message = topic_preferences_management.update_topic_preferences_from_processed_topic_scores(user_id=user_id)
+        message = topic_preferences_management.update_topic_preferences_from_processed_topic_scores(user_id=user_id, user_context=userContext)
     except Exception as e:
         print(e)
 
 
-    
+def getProfileJobs():
+    """
+    Returns the job queue that updates the user profiles in the background, started on first use.
+    """
+    global profileJobs
+    with profileJobsLock:
+        if profileJobs is None:
+            profileJobs=KeyedJobQueue(num_workers=config.settings.PROFILE_JOB_WORKERS, name='profile-jobs')
+    return profileJobs
+
+def runProcessFeedback(userId):
+    # Jobs read the latest committed profile when they run, not the one of the request that scheduled them
+    userContext=UserContext.load(userId)
+    if userContext is None:
+        print("User {} does not exist anymore, skipping feedback processing".format(userId))
+        return
+    invokeProcessFeedback(userContext)
+
+def runUpdateModel(userId):
+    userContext=UserContext.load(userId.strip('"'))
+    if userContext is None:
+        print("User {} does not exist anymore, skipping model update".format(userId))
+        return
+    invokeUpdateModel(userId, userContext)
+
+def scheduleProcessFeedback(userId):
+    """
+    Processes the new feedbacks of the user in the background, after the previously scheduled jobs of the user.
+    """
+    return getProfileJobs().submit(userId, 'processFeedback', runProcessFeedback, userId)
+
+def scheduleUpdateModel(userId):
+    """
+    Recomputes the topic preferences of the user in the background, after the previously scheduled jobs of the user.
+    """
+    return getProfileJobs().submit(userId, 'updateModel', runUpdateModel, userId)
+
+def runCommit(userContext, future):
+    try:
+        future.set_result(userContext.commit())
+    except Exception as e:
+        future.set_exception(e)
 
+def scheduleCommit(userId, userContext):
+    """
+    Writes the pending changes of the user context in the queue of the user's profile jobs, so that they are never
+    overwritten by a background job that read the profile before them (e.g. processFeedback).
 
+    :return: A Future with the result of the commit.
+    """
+    future=Future()
+    getProfileJobs().submit(userId, 'commit-{}'.format(next(commitJobIds)), runCommit, userContext, future)
+    return future
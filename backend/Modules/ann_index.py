@@ -0,0 +1,151 @@
+import json
+import os
+import time
+
+import numpy as np
+
+# Files written to the run directory by build_ann_index
+CENTROIDS_FILE = 'ann_centroids.npy'
+LIST_OFFSETS_FILE = 'ann_list_offsets.npy'
+LIST_ORDINALS_FILE = 'ann_list_ordinals.npy'
+RECALL_REPORT_FILE = 'ann_recall_report.json'
+
+
+def _assign(matrix, centroids, batch_size=65536):
+    # Nearest centroid (highest cosine similarity) of every row, computed in batches
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), batch_size):
+        batch = np.asarray(matrix[start:start + batch_size], dtype=np.float32)
+        assignments[start:start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(matrix, n_lists, n_iterations=20, max_training_rows=100000, seed=0):
+    """
+    Spherical k-means over the L2-normalised rows of the matrix.
+
+    :param matrix: Video-by-topic matrix with L2-normalised rows.
+    :param n_lists: Number of centroids (inverted lists).
+    :param n_iterations: Number of k-means iterations.
+    :param max_training_rows: Centroids are trained on a random sample of at most this many rows.
+    :return: float32 array of shape (n_lists, num_topics) with L2-normalised centroids.
+    """
+    rng = np.random.default_rng(seed)
+    num_rows = len(matrix)
+    sample = np.sort(rng.choice(num_rows, size=min(num_rows, max_training_rows), replace=False))
+    training = np.asarray(matrix[sample], dtype=np.float32)
+
+    centroids = training[rng.choice(len(training), size=n_lists, replace=False)].copy()
+    for _ in range(n_iterations):
+        assignments = _assign(training, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, training)
+        counts = np.bincount(assignments, minlength=n_lists)
+        # Re-seed empty lists with random training rows
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = training[rng.choice(len(training), size=len(empty), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.where(norms > 0, norms, 1)
+    return centroids.astype(np.float32)
+
+
+class AnnIndex:
+    """
+    Inverted file (IVF) index over the rows of the similarity matrix.
+
+    Every video belongs to the list of its nearest centroid. A search scores the centroids, keeps the nprobe
+    best lists and scores only the videos of those lists exactly. Higher nprobe means higher recall and latency.
+    """
+
+    def __init__(self, centroids, list_offsets, list_ordinals):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ordinals = list_ordinals
+
+    @classmethod
+    def load(cls, run_dir):
+        """
+        Loads the files written by build_ann_index.
+
+        :return: An AnnIndex, or None if the run directory has no ANN index.
+        """
+        centroids_path = os.path.join(run_dir, CENTROIDS_FILE)
+        if not os.path.exists(centroids_path):
+            return None
+        return cls(np.load(centroids_path),
+                   np.load(os.path.join(run_dir, LIST_OFFSETS_FILE)),
+                   np.load(os.path.join(run_dir, LIST_ORDINALS_FILE), mmap_mode='r'))
+
+    def candidates(self, query, nprobe):
+        """
+        Returns the ordinals of the videos in the nprobe lists closest to the normalised query vector.
+        """
+        nprobe = min(nprobe, len(self.centroids))
+        centroid_scores = self.centroids @ query
+        lists = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.concatenate([self.list_ordinals[self.list_offsets[list_id]:self.list_offsets[list_id + 1]]
+                               for list_id in lists])
+
+
+def build_ann_index(run_dir, n_lists=None, n_iterations=20, seed=0):
+    """
+    Builds the IVF index of the similarity matrix of a run (see similarity_engine.build_similarity_matrix)
+    and saves it into the run directory.
+
+    :param run_dir: The directory of the topic modeling run.
+    :param n_lists: Number of inverted lists, by default about 4 * sqrt(number of videos).
+    :return: The AnnIndex.
+    """
+    from Modules import similarity_engine
+
+    matrix = np.load(os.path.join(run_dir, similarity_engine.MATRIX_FILE), mmap_mode='r')
+    if n_lists is None:
+        n_lists = int(4 * np.sqrt(len(matrix)))
+    n_lists = max(1, min(n_lists, len(matrix)))
+
+    centroids = train_centroids(matrix, n_lists, n_iterations=n_iterations, seed=seed)
+    assignments = _assign(matrix, centroids)
+    list_ordinals = np.argsort(assignments, kind='stable').astype(np.int32)
+    list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=n_lists))
+
+    np.save(os.path.join(run_dir, CENTROIDS_FILE), centroids)
+    np.save(os.path.join(run_dir, LIST_OFFSETS_FILE), list_offsets)
+    np.save(os.path.join(run_dir, LIST_ORDINALS_FILE), list_ordinals)
+    print(f"ANN index: wrote {n_lists} lists over {len(matrix)} videos to {run_dir}.")
+    return AnnIndex(centroids, list_offsets, list_ordinals)
+
+
+def write_recall_report(run_dir, k=10, n_queries=200, nprobes=(1, 2, 4, 8, 16, 32), seed=0):
+    """
+    Measures recall@k and latency of the ANN search against the exact search for several values of nprobe.
+    The queries are the topic distributions of randomly chosen videos. The report is saved as
+    ann_recall_report.json in the run directory.
+
+    :return: The report as a dict.
+    """
+    from Modules import similarity_engine
+
+    engine = similarity_engine.SimilarityEngine.load(run_dir)
+    rng = np.random.default_rng(seed)
+    query_ordinals = rng.choice(len(engine.video_ids), size=min(n_queries, len(engine.video_ids)), replace=False)
+    queries = [np.asarray(engine.matrix[ordinal]) for ordinal in query_ordinals]
+
+    def run(nprobe):
+        start = time.perf_counter()
+        results = [engine.search_ordinals(query, (), k, nprobe=nprobe) for query in queries]
+        return results, (time.perf_counter() - start) * 1000 / len(queries)
+
+    exact_results, exact_latency = run(0)
+    report = {'k': k, 'n_queries': len(queries), 'n_lists': len(engine.ann.centroids),
+              'exact_latency_ms': exact_latency, 'nprobe': {}}
+    for nprobe in nprobes:
+        ann_results, latency = run(nprobe)
+        recall = np.mean([len(set(exact).intersection(ann)) / max(len(exact), 1)
+                          for exact, ann in zip(exact_results, ann_results)])
+        report['nprobe'][str(nprobe)] = {'recall': float(recall), 'latency_ms': latency}
+        print(f"ANN index: nprobe={nprobe} recall@{k}={recall:.3f} latency={latency:.2f}ms (exact {exact_latency:.2f}ms)")
+
+    with open(os.path.join(run_dir, RECALL_REPORT_FILE), 'w') as file:
+        json.dump(report, file, indent=4)
+    return report
@@ -0,0 +1,133 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from elasticsearch.exceptions import ApiError, TransportError
+
+
+class AdaptiveBulkWriter:
+    """
+    Writes a stream of bulk operations with several _bulk requests in flight and a batch size that adapts
+    to the cluster: it grows while requests return faster than target_latency_seconds, shrinks when they are
+    slower and is halved when Elasticsearch rejects operations (HTTP 429). Rejected operations are retried in
+    later batches after a backoff, at most max_retries times.
+
+    The operations are (action, source) tuples as sent in a _bulk body, e.g.
+    ({"update": {"_index": "videos", "_id": video_id}}, {"doc": {...}}).
+    """
+
+    def __init__(self, client, workers=4, initial_batch_size=500, min_batch_size=50, max_batch_size=5000,
+                 target_latency_seconds=1.0, max_retries=5, initial_backoff_seconds=0.5):
+        self.client = client
+        self.workers = workers
+        self.batch_size = initial_batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency_seconds = target_latency_seconds
+        self.max_retries = max_retries
+        self.initial_backoff_seconds = initial_backoff_seconds
+
+    def write(self, operations):
+        """
+        Writes all operations.
+
+        :param operations: Iterable of (action, source) tuples, consumed lazily.
+        :return: Dict with the number of 'written', 'failed' and 'retried' operations and the 'batches' sent.
+        """
+        stats = {'written': 0, 'failed': 0, 'retried': 0, 'batches': 0}
+        operations = iter(operations)
+        retries = deque()  # (operation, attempts)
+        consecutive_rejections = 0
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = set()
+            while True:
+                while len(in_flight) < self.workers:
+                    batch = self._take_batch(retries, operations)
+                    if not batch:
+                        break
+                    in_flight.add(pool.submit(self._send, batch))
+                if not in_flight:
+                    break
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                rejected_any = False
+                for future in done:
+                    latency, written, failed, rejected = future.result()
+                    stats['batches'] += 1
+                    stats['written'] += written
+                    stats['failed'] += failed
+                    for operation, attempts in rejected:
+                        if attempts >= self.max_retries:
+                            stats['failed'] += 1
+                        else:
+                            retries.append((operation, attempts + 1))
+                            stats['retried'] += 1
+                    rejected_any = rejected_any or bool(rejected)
+                    self._adapt(latency, bool(rejected))
+
+                if rejected_any:
+                    # Back off before sending more, the cluster is overloaded
+                    consecutive_rejections += 1
+                    time.sleep(self.initial_backoff_seconds * 2 ** min(consecutive_rejections - 1, 5))
+                else:
+                    consecutive_rejections = 0
+        return stats
+
+    def _take_batch(self, retries, operations):
+        batch = []
+        while retries and len(batch) < self.batch_size:
+            batch.append(retries.popleft())
+        for operation in operations:
+            batch.append((operation, 0))
+            if len(batch) >= self.batch_size:
+                break
+        return batch
+
+    def _adapt(self, latency, rejected):
+        if rejected:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        elif latency > self.target_latency_seconds:
+            self.batch_size = max(self.min_batch_size, int(self.batch_size * 0.75))
+        elif latency < self.target_latency_seconds / 2:
+            self.batch_size = min(self.max_batch_size, int(self.batch_size * 1.25) + 1)
+
+    def _send(self, batch):
+        """
+        Sends one _bulk request.
+
+        :return: Tuple (latency in seconds, number of written operations, number of failed operations,
+                 list of rejected (operation, attempts) to retry).
+        """
+        body = []
+        for (action, source), _ in batch:
+            body.append(action)
+            if source is not None:
+                body.append(source)
+
+        start = time.perf_counter()
+        try:
+            response = self.client.bulk(operations=body)
+        except (ApiError, TransportError) as e:
+            latency = time.perf_counter() - start
+            if getattr(e, 'status_code', None) == 429:
+                return latency, 0, 0, batch
+            print(f"Error sending a bulk request of {len(batch)} operations: {e}")
+            return latency, 0, len(batch), []
+        latency = time.perf_counter() - start
+
+        written = 0
+        failed = 0
+        rejected = []
+        for item, operation in zip(response['items'], batch):
+            result = next(iter(item.values()))
+            status = result.get('status', 200)
+            if status == 429:
+                rejected.append(operation)
+            elif status >= 300:
+                failed += 1
+                if failed == 1:
+                    print(f"Error in bulk operation on '{result.get('_id')}': {result.get('error')}")
+            else:
+                written += 1
+        return latency, written, failed, rejected
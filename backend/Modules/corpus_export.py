@@ -0,0 +1,136 @@
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from elasticsearch.exceptions import TransportError
+
+from Modules import database_queries, language_cache
+from Modules.database_queries import es
+from Modules.language_cache import detect_language, text_hash
+
+# Columns of the exported corpus, the textual features of topic_modeling.get_textual_features
+CORPUS_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('title', pa.string()),
+    ('description', pa.string()),
+    ('tags', pa.list_(pa.string())),
+    ('wikipedia_tags', pa.list_(pa.string())),
+    ('link', pa.string()),
+    ('defaultLanguage', pa.string()),
+    ('defaultAudioLanguage', pa.string()),
+    ('predictedLanguage', pa.string()),
+    ('duration', pa.int64()),
+])
+
+
+def hit_to_record(hit):
+    """
+    Converts a hit of the 'videos' index into a row of the corpus, without the predicted language.
+
+    :return: Tuple (record, text to detect the language of, or None if the video has no snippet).
+    """
+    video_data = database_queries.parse_hit(hit=hit, detect_language=False)
+    record = {
+        'id': video_data['id'],
+        'title': video_data['title'],
+        'description': video_data['description'],
+        'tags': video_data['tags'],
+        'wikipedia_tags': video_data['topicCategories'],
+        'link': video_data['link'],
+        'defaultLanguage': video_data['defaultLanguage'],
+        'defaultAudioLanguage': video_data['defaultAudioLanguage'],
+        'predictedLanguage': '',
+        'duration': video_data.get('duration', 1000)
+    }
+    snippet = hit['_source'].get('snippet')
+    text = snippet['title'] + " " + snippet['description'] if snippet else None
+    return record, text
+
+
+def _export_slice(slice_id, num_slices, output_dir, language_pool, page_size, counter):
+    """
+    Scrolls one slice of the 'videos' index and writes every page as a Parquet file of the partition slice=<slice_id>.
+
+    :return: The number of exported videos.
+    """
+    partition_dir = os.path.join(output_dir, f"slice={slice_id}")
+    os.makedirs(partition_dir, exist_ok=True)
+    body = {"query": {"match_all": {}}}
+    if num_slices > 1:
+        body["slice"] = {"id": slice_id, "max": num_slices}
+
+    cache = language_cache.get_cache()
+    exported = 0
+    page = es.search(index='videos', scroll='10m', size=page_size, body=body)
+    scroll_id = page['_scroll_id']
+    try:
+        part = 0
+        while page['hits']['hits']:
+            records, texts = zip(*(hit_to_record(hit) for hit in page['hits']['hits']))
+            # Languages of unchanged texts come from the cache, the others are detected in the process pool
+            hashes = {i: text_hash(text) for i, text in enumerate(texts) if text is not None}
+            cached_languages = cache.get_many(hashes.values())
+            detect_indices = [i for i, hash_ in hashes.items() if hash_ not in cached_languages]
+            languages = language_pool.map(detect_language, [texts[i] for i in detect_indices], chunksize=64)
+            detected_languages = {hashes[i]: language for i, language in zip(detect_indices, languages)}
+            cache.put_many(detected_languages)
+            for i, hash_ in hashes.items():
+                records[i]['predictedLanguage'] = cached_languages.get(hash_, detected_languages.get(hash_))
+
+            table = pa.Table.from_pylist(list(records), schema=CORPUS_SCHEMA)
+            pq.write_table(table, os.path.join(partition_dir, f"part-{part:05d}.parquet"))
+            part += 1
+            exported += len(records)
+            with counter['lock']:
+                counter['videos'] += len(records)
+                print(f"Exported {counter['videos']} videos")
+
+            page = es.scroll(scroll_id=scroll_id, scroll='10m')
+            scroll_id = page['_scroll_id']
+    finally:
+        try:
+            es.clear_scroll(scroll_id=scroll_id)
+        except TransportError as e:
+            print(f"Error during scrolling: {e}")
+    return exported
+
+
+def export_corpus(output_dir, num_slices=4, language_workers=None, page_size=2000):
+    """
+    Exports the textual features of all videos of the 'videos' index to a partitioned Parquet dataset.
+    The index is read with a sliced scroll, one thread per slice. Every page is written to its own file as soon
+    as it is read, so the corpus never has to fit in memory. The languages are detected in a process pool,
+    except for the texts whose language is in the language cache (see language_cache).
+
+    :param output_dir: Directory of the dataset, replaced if it exists.
+    :param num_slices: Number of slices scrolled in parallel.
+    :param language_workers: Number of language detection processes, by default the number of CPUs.
+    :param page_size: Number of videos per page (and Parquet file).
+    :return: The number of exported videos.
+    """
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+
+    counter = {'videos': 0, 'lock': threading.Lock()}
+    with ProcessPoolExecutor(max_workers=language_workers) as language_pool, \
+            ThreadPoolExecutor(max_workers=num_slices) as slice_pool:
+        futures = [slice_pool.submit(_export_slice, slice_id, num_slices, output_dir, language_pool, page_size, counter)
+                   for slice_id in range(num_slices)]
+        exported = sum(future.result() for future in futures)
+    print(f"Exported {exported} videos to {output_dir}.")
+    return exported
+
+
+def read_corpus(output_dir):
+    """
+    Reads the dataset written by export_corpus into a DataFrame.
+    """
+    df = pq.read_table(output_dir, schema=CORPUS_SCHEMA).to_pandas()
+    # List columns as lists, like in the DataFrames built from the database
+    for column in ['tags', 'wikipedia_tags']:
+        df[column] = df[column].map(list)
+    return df
@@ -1,6 +1,13 @@
 # from Modules import helper_functions
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk
+from elasticsearch.exceptions import NotFoundError
+from Modules import topic_catalog, exclusion_filter
+from Modules.database_queries import write_refresh
+from Modules.write_behind import WriteBehindBuffer
+import config.settings
 import random
+import threading
 
 # Define database url and credentials
 url = "http://localhost:9200/"
@@ -13,36 +20,25 @@ es = Elasticsearch(
     basic_auth=(username, password)
 )
 
+# Write-behind buffer of the interactions, see getInteractionBuffer
+interactionBuffer = None
+interactionBufferLock = threading.Lock()
+
 def load_topics(index_name='topics'):
     """
-    Fetches topic descriptions from the Elasticsearch index.
+    Returns a random selection of topics with their descriptions, served from the in-process topic catalog.
 
     :param index_name: Name of the Elasticsearch index containing topics data.
-    :return: A dictionary mapping each topic number to its description.
+    :return: A list of at most 80 topic dicts with 'id', 'topicNumber' and 'description'.
     """
-
-    # Prepare a search query to fetch all documents from the index
-    query = {
-        "size": 1000,  # Adjust this value based on the expected number of topics
-        "query": {
-            "match_all": {}
-        },
-         "fields": ["topicNumber","description","document_count","tokens"]
-    }
-
-    # Execute the search query
-    response = es.search(index=index_name,body=query)
     topics = []
-    for hit in response['hits']['hits']:
-        topic_number = hit['_source'].get('topic_number')  # Adjust field name as necessary
-        description = hit['_source'].get('description')
-        if topic_number is not None and description is not None:
-            temp={
-                'id':topic_number,
-                'topicNumber':topic_number,
-                'description':description
-            }
-            topics.append(temp)
+    for topic_number, description in topic_catalog.get_descriptions().items():
+        temp={
+            'id':topic_number,
+            'topicNumber':topic_number,
+            'description':description
+        }
+        topics.append(temp)
     random.shuffle(topics)
     topics=topics[:80]
     return topics
@@ -53,19 +49,16 @@ def deleteByUserId(userId,index_name='users'):
 
 
 def findByUserId(userId,index_name='users'):
-    if es.exists(index=index_name, id=userId):
+    try:
         return es.get(index=index_name, id=userId)['_source']
-    else:
+    except NotFoundError:
         return None
     
 
 def saveUser(user,index_name='users'):
-    res = es.index(index=index_name, id=user['userId'], body=user)
-    resp = es.indices.refresh(
-        index=index_name,
-    )
+    res = es.index(index=index_name, id=user['userId'], body=user, refresh=write_refresh())
 
-    return resp
+    return res
 
 def findByUserIdAndTimestampGreaterThan(userId, feedbackLastUsed,index_name='feedback'):
     search_query = {
@@ -93,14 +86,17 @@ def findByUserIdAndTimestampGreaterThan(userId, feedbackLastUsed,index_name='fee
     return feedbacks
 
 def findTopicById(topicId,index_name='topics'):
-    topic=es.get(index=index_name, id=topicId)['_source']
+    topic=topic_catalog.get_topic(topicId)
+    if topic is None:
+        # Unknown to the catalog, fall back to the index
+        topic=es.get(index=index_name, id=topicId)['_source']
     return topic
 
 def findVideoById(videoId,index_name='videos'):
     video=es.get(index=index_name, id=videoId)['_source']
     return video
 
-def findVideoByKeyword(keyword,page,index_name='videos'):
+def buildKeywordQuery(keyword):
     search_query = {
         "bool": {
             "should": [
@@ -124,8 +120,10 @@ def findVideoByKeyword(keyword,page,index_name='videos'):
             "minimum_should_match":1
         }
     }
-    
-    resp = es.search(index=index_name,from_=page,query=search_query,size=20)
+    return search_query
+
+def findVideoByKeyword(keyword,page,index_name='videos'):
+    resp = es.search(index=index_name,from_=page,query=buildKeywordQuery(keyword),size=20)
     videos = [hit['_source'] for hit in resp['hits']['hits']]
     return videos
 
@@ -135,25 +133,77 @@ def findtopicDistributionById(videoId,index_name='topic_distributions'):
 
 
 def saveFeedback(feedback,index_name="feedback"):
-    res = es.index(index=index_name, id=feedback['id'], body=feedback)
-    resp = es.indices.refresh(
-        index=index_name,
-    )
+    res = es.index(index=index_name, id=feedback['id'], body=feedback, refresh=write_refresh(searched=True))
+
+    return res
+
+
+def mergeFeedbacks(feedbacks):
+    """
+    Merges the feedbacks of a batch that share the same id, fields of later feedbacks win.
+    Returns one feedback per id in the order of their first occurrence.
+    """
+    mergedFeedbacks={}
+    for feedback in feedbacks:
+        mergedFeedbacks.setdefault(feedback['id'], {}).update(feedback)
+    return list(mergedFeedbacks.values())
 
-    return resp
 
+def buildFeedbackActions(feedbacks,index_name="feedback"):
+    """
+    Returns the bulk index actions for a batch of feedbacks, merged with mergeFeedbacks.
+    """
+    return [{
+        "_op_type":"index",
+        "_index":index_name,
+        "_id":feedback['id'],
+        "_source":feedback
+    } for feedback in mergeFeedbacks(feedbacks)]
 
-def saveInteraction(interaction,index_name="interaction"):
-    res = es.index(index=index_name, body=interaction)
-    resp = es.indices.refresh(
-        index=index_name,
-    )
 
-    return resp
+def saveFeedbacks(feedbacks,index_name="feedback"):
+    """
+    Writes a batch of feedbacks with a single bulk request.
+    """
+    actions=buildFeedbackActions(feedbacks,index_name)
+    if not actions:
+        return None
+    # Send the whole batch in one request regardless of its size
+    res=bulk(es, actions, chunk_size=len(actions), max_chunk_bytes=2**31-1, refresh=write_refresh(searched=True))
+    addWatchedVideos(feedbacks)
+    return res
 
 
-    
+def addWatchedVideos(feedbacks):
+    """
+    Adds the videos of saved feedbacks to the cached exclusions of their users.
+    """
+    watchedVideos={}
+    for feedback in feedbacks:
+        watchedVideos.setdefault(feedback['userId'], []).append(feedback['videoId'])
+    for userId, videoIds in watchedVideos.items():
+        exclusion_filter.add_excluded_videos(userId, videoIds)
 
-    
+
+def getInteractionBuffer(index_name="interaction"):
+    """
+    Returns the write-behind buffer of the interactions, started on first use.
+    """
+    global interactionBuffer
+    with interactionBufferLock:
+        if interactionBuffer is None:
+            interactionBuffer=WriteBehindBuffer(
+                index_name,
+                max_size=config.settings.INTERACTION_BUFFER_MAX_SIZE,
+                batch_size=config.settings.INTERACTION_BUFFER_BATCH_SIZE,
+                flush_interval_seconds=config.settings.INTERACTION_BUFFER_FLUSH_SECONDS,
+                put_timeout_seconds=config.settings.INTERACTION_BUFFER_PUT_TIMEOUT_SECONDS
+            )
+    return interactionBuffer
+
+
+def saveInteraction(interaction):
+    # Interactions are never read back by the backend, they are written in the background
+    return getInteractionBuffer().put(interaction)
 
 
@@ -1,14 +1,16 @@
 import sys
 sys.path.append('/Users/pablojerezarnau/git/RS-backend/')
 
-from Modules import helper_functions
+from Modules import helper_functions, language_cache
 from elasticsearch import Elasticsearch, helpers
 from elasticsearch.exceptions import TransportError, NotFoundError
 from elasticsearch.helpers import bulk, scan
 import time
-from langdetect import detect, LangDetectException
 import json
 import os
+import numpy as np
+import config.settings
+from Modules.bulk_writer import AdaptiveBulkWriter
 
 
 # Define database url and credentials
@@ -24,7 +26,56 @@ es = Elasticsearch(
 
 
 
-def parse_hit(hit):
+def write_refresh(searched=False):
+    """
+    Returns the value of the 'refresh' parameter of single-document writes for the configured
+    ES_WRITE_DURABILITY, or ES_SEARCHED_WRITE_DURABILITY for writes that a later search must see
+    (see config/settings.py).
+    """
+    durability = config.settings.ES_SEARCHED_WRITE_DURABILITY if searched else config.settings.ES_WRITE_DURABILITY
+    if durability == 'none':
+        return False
+    if durability == 'wait_for':
+        return 'wait_for'
+    if durability == 'immediate':
+        return True
+    raise ValueError(f"Unknown ES_WRITE_DURABILITY '{durability}', expected 'none', 'wait_for' or 'immediate'.")
+
+
+def predict_languages(hits):
+    """
+    Predicts the language of the title and description of every hit with one lookup in the language cache
+    for all hits; only the texts missing from the cache are run through language detection.
+
+    :return: List with the predicted language of every hit, '' for hits without snippet or undetectable text.
+    """
+    texts = {i: hit['_source']['snippet']['title'] + " " + hit['_source']['snippet']['description']
+             for i, hit in enumerate(hits) if 'snippet' in hit['_source']}
+    hashes = {i: language_cache.text_hash(text) for i, text in texts.items()}
+    cache = language_cache.get_cache()
+    languages = cache.get_many(set(hashes.values()))
+    detected_languages = {}
+    for i, hash_ in hashes.items():
+        if hash_ not in languages and hash_ not in detected_languages:
+            detected_languages[hash_] = language_cache.detect_language(texts[i])
+    if detected_languages:
+        cache.put_many(detected_languages)
+        languages.update(detected_languages)
+    return [languages[hashes[i]] if i in hashes else '' for i in range(len(hits))]
+
+
+def parse_hits(hits, detect_language=True):
+    """
+    parse_hit for a page of hits, predicting the languages of all of them at once (see predict_languages).
+    """
+    videos = [parse_hit(hit, detect_language=False) for hit in hits]
+    if detect_language:
+        for video, language in zip(videos, predict_languages(hits)):
+            video['predictedLanguage'] = language
+    return videos
+
+
+def parse_hit(hit, detect_language=True):
     video_id = hit['_id']
     source = hit['_source']
     defaultLanguage = ''
@@ -43,11 +94,8 @@ def parse_hit(hit):
         
         # Predict language based on title and description
         predicted_language = ''
-        try:
-            text = snippet['title'] + " " + snippet['description']
-            predicted_language = detect(text)
-        except LangDetectException:
-            print('langerror')
+        if detect_language:
+            predicted_language = predict_languages([hit])[0]
         # Extract additional data from snippet
         title = snippet['title']
         description = snippet['description']
@@ -115,10 +163,8 @@ def get_entire_database():
 
             # Process the batch
             videos_dict = {}
-            for hit in page['hits']['hits']:
-
-                # parse hit
-                video_data = parse_hit(hit=hit)
+            # parse the hits of the page, with one language cache lookup for the page
+            for video_data in parse_hits(page['hits']['hits']):
 
                 # add video data to the list
                 videos_dict[video_data['id']] = video_data
@@ -163,57 +209,146 @@ def remove_topic_distributions_from_all_videos():
         print(f"Error removing topic_distribution from videos: {e}")
 
 
-def write_topic_distributions(df, batch_size=200):
+def remove_stale_topic_distributions(current_video_ids):
     """
-    Writes or updates the topic_distribution field for multiple video documents in Elasticsearch using bulk operations,
-    with operations grouped in batches to be mindful of database limitations.
-    First removes the topic_distribution field from all documents to ensure only current distributions remain.
+    Removes the topic_distribution field from the video documents that have one but are not in current_video_ids,
+    i.e. the videos that are no longer part of the topic modeling run.
 
-    Parameters:
-    - df: DataFrame containing video IDs and their corresponding topic distributions.
-    - batch_size: The maximum number of operations to include in a single batch.
+    :param current_video_ids: Set of the IDs of the videos with a current topic distribution.
+    :return: The number of videos whose topic distribution was removed.
     """
-    # Remove existing topic_distribution from all documents first
-    remove_topic_distributions_from_all_videos()
+    query = {"query": {"exists": {"field": "topic_distribution"}}}
+    stale_ids = [hit['_id'] for hit in scan(client=es, index='videos', query=query, _source=False)
+                 if hit['_id'] not in current_video_ids]
+    if not stale_ids:
+        return 0
 
-    actions = []
+    script = {"source": "ctx._source.remove('topic_distribution')"}
+    operations = (({"update": {"_index": "videos", "_id": video_id}}, {"script": script}) for video_id in stale_ids)
+    stats = _topic_distribution_writer().write(operations)
+    print(f"Removed topic_distribution from {stats['written']} videos that are no longer in the run.")
+    return stats['written']
 
-    # Function to process actions in bulk
-    def process_bulk_actions(actions_batch):
-        try:
-            successes, _ = bulk(es, actions_batch)
-            print(
-                f"Successfully updated/added topic_distribution for {successes} videos.")
-        except Exception as e:
-            print(f"Error updating/adding topic_distribution for videos: {e}")
-
-    for index, row in df.iterrows():
-        video_id = row['id']
-        topic_distribution = row['topic_distribution']
-
-        # Ensure topic_distribution is a list of floats
-        if not isinstance(topic_distribution, list):
-            topic_distribution = [topic_distribution]
-        topic_distribution = [float(value) for value in topic_distribution]
-
-        action = {
-            "_op_type": "update",
-            "_index": "videos",
-            "_id": video_id,
-            "doc": {"topic_distribution": topic_distribution},
-            "doc_as_upsert": True
-        }
 
-        actions.append(action)
+def _topic_distribution_writer():
+    return AdaptiveBulkWriter(es,
+                              workers=config.settings.BULK_WRITER_WORKERS,
+                              initial_batch_size=config.settings.BULK_WRITER_INITIAL_BATCH_SIZE,
+                              target_latency_seconds=config.settings.BULK_WRITER_TARGET_LATENCY_SECONDS)
 
-        # If the current batch is full, process it
-        if len(actions) >= batch_size:
-            process_bulk_actions(actions)
-            actions = []  # Reset actions for the next batch
 
-    # Process any remaining actions that didn't fill the last batch
-    if actions:
-        process_bulk_actions(actions)
+def write_topic_distributions(df):
+    """
+    Writes or updates the topic_distribution field for multiple video documents in Elasticsearch using bulk operations.
+    The updates are streamed with several bulk requests in flight and a batch size that adapts to the observed
+    latency and rejections (see bulk_writer.AdaptiveBulkWriter). Afterwards, the topic_distribution field is removed
+    from the videos that are not in the DataFrame, so that only current distributions remain.
+
+    Parameters:
+    - df: DataFrame containing video IDs and their corresponding topic distributions.
+
+    Returns:
+    - Dict with the number of 'written' and 'failed' updates and of 'removed' stale distributions.
+    """
+    video_ids = df['id'].tolist()
+    # Ensure every topic_distribution is a list of floats
+    topic_distributions = np.asarray(df['topic_distribution'].tolist(), dtype=np.float64).reshape(len(df), -1).tolist()
+
+    operations = (({"update": {"_index": "videos", "_id": video_id}},
+                   {"doc": {"topic_distribution": topic_distribution}, "doc_as_upsert": True})
+                  for video_id, topic_distribution in zip(video_ids, topic_distributions))
+    stats = _topic_distribution_writer().write(operations)
+    print(f"Successfully updated/added topic_distribution for {stats['written']} videos "
+          f"({stats['failed']} failed, {stats['batches']} bulk requests).")
+
+    removed = remove_stale_topic_distributions(set(video_ids))
+    return {'written': stats['written'], 'failed': stats['failed'], 'removed': removed}
+
+
+def publish_topic_distributions(run_id, documents, alias="topic_distributions"):
+    """
+    Publishes the topic distributions of a run without downtime: the documents are loaded into a new index
+    named after the run, which replaces the previous one behind the alias 'topic_distributions' in one atomic
+    step once it holds all documents. Readers never see an empty or half-filled index.
+
+    The new index gets the mappings of the index currently behind the alias. It is loaded with parallel_bulk,
+    without replicas and with refresh disabled; both are restored before the swap. If anything fails before the
+    swap, the new index is deleted and the error is raised again.
+
+    :param run_id: The ID of the topic modeling run, used in the name of the new index together with a timestamp.
+    :param documents: Iterable of (document ID, document source) tuples.
+    :param alias: The alias the readers query.
+    :return: True if the new index was published, False if it was not (the alias is left untouched).
+    """
+    # Versioned by the time of publishing, so that a run can be republished
+    index_name = f"{alias}_{run_id}_{int(time.time())}".lower()
+    while es.indices.exists(index=index_name):
+        index_name += "_1"
+
+    # Indices currently behind the alias, or a concrete index with the name of the alias (before the first swap)
+    old_indices = []
+    mappings = {}
+    replicas = "1"
+    if es.indices.exists(index=alias):
+        old_indices = list(es.indices.get(index=alias).keys())
+        current = old_indices[0]
+        mappings = es.indices.get_mapping(index=current)[current]['mappings']
+        replicas = es.indices.get_settings(index=current)[current]['settings']['index'].get('number_of_replicas', "1")
+    is_alias = es.indices.exists_alias(name=alias)
+
+    es.indices.create(index=index_name, mappings=mappings or None,
+                      settings={"number_of_replicas": 0, "refresh_interval": "-1"})
+    try:
+        # Load the documents. A video ID that occurs more than once is written once (the last document wins)
+        doc_ids = set()
+
+        def actions():
+            for doc_id, source in documents:
+                doc_ids.add(doc_id)
+                yield {"_index": index_name, "_id": doc_id, "_source": source}
+
+        sent = 0
+        failed = 0
+        for ok, info in helpers.parallel_bulk(es, actions(), thread_count=config.settings.PUBLISH_BULK_THREADS,
+                                              chunk_size=config.settings.PUBLISH_BULK_CHUNK_SIZE, raise_on_error=False):
+            sent += 1
+            if not ok:
+                failed += 1
+                if failed <= 10:
+                    print(f"Error indexing into '{index_name}': {info}")
+
+        # Restore refresh and replicas and wait until the new index can serve searches
+        es.indices.put_settings(index=index_name, settings={"refresh_interval": None, "number_of_replicas": replicas})
+        es.indices.refresh(index=index_name)
+        es.cluster.health(index=index_name, wait_for_status="yellow", timeout="60s")
+
+        # Validate before swapping
+        count = es.count(index=index_name)['count']
+        if failed or count != len(doc_ids):
+            print(f"Not publishing '{index_name}': {sent} documents sent ({len(doc_ids)} distinct IDs), "
+                  f"{failed} failed, {count} in the index.")
+            es.indices.delete(index=index_name)
+            return False
+    except Exception:
+        # Never leave a half-loaded index without replicas and refresh behind
+        print(f"Publishing '{index_name}' failed, deleting it.")
+        es.indices.delete(index=index_name, ignore_unavailable=True)
+        raise
+
+    # Atomic swap
+    if is_alias:
+        swap = [{"remove": {"index": old_index, "alias": alias}} for old_index in old_indices]
+    else:
+        # A concrete index with the name of the alias is dropped in the same atomic step
+        swap = [{"remove_index": {"index": old_index}} for old_index in old_indices]
+    swap.append({"add": {"index": index_name, "alias": alias}})
+    es.indices.update_aliases(actions=swap)
+    print(f"Published {count} documents in '{index_name}' as '{alias}'.")
+
+    if is_alias:
+        for old_index in old_indices:
+            es.indices.delete(index=old_index, ignore_unavailable=True)
+    return True
 
 
 def upload_topic_distributions_to_database(run_id, TOPIC_MODELING_RUNS_DIR):
@@ -225,33 +360,22 @@ def upload_topic_distributions_to_database(run_id, TOPIC_MODELING_RUNS_DIR):
     :param TOPIC_MODELING_RUNS_DIR: The root directory containing run directories.
     """
     file_path = os.path.join(TOPIC_MODELING_RUNS_DIR, run_id, 'topic_distributions.json')
-    
-    # Remove existing documents from the index for this run
-    query = {"query": {"match_all": {}}}
-    es.delete_by_query(index="topic_distributions", body=query)
-    
-    # Prepare bulk upload data
-    actions = []
-    with open(file_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            doc = json.loads(line)
-            most_relevant_topics = [{"topic_index": k, "topic_score": v} for k, v in doc['most_relevant_topics'].items()]
-            action = {
-                "_index": "topic_distributions",
-                "_id": doc['id'],
-                "_source": {
+
+    # Generator function to read and yield documents from the file
+    def generate_documents():
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                doc = json.loads(line)
+                most_relevant_topics = [{"topic_index": k, "topic_score": v} for k, v in doc['most_relevant_topics'].items()]
+                yield doc['id'], {
                     "video_id": doc['id'],
                     "topic_distribution": doc['topic_distribution'],
                     "most_relevant_topics": most_relevant_topics,
                     "most_relevant_topic": doc['most_relevant_topic']
                 }
-            }
-            actions.append(action)
 
-    # Use the bulk API to perform the index operations
-    if actions:
-        helpers.bulk(es, actions)
-        print(f"Uploaded {len(actions)} documents to 'topic_distributions' index.")
+    # Replace the index behind the 'topic_distributions' alias
+    publish_topic_distributions(run_id, generate_documents())
 
 
 def verify_topic_distributions(df):
@@ -334,10 +458,7 @@ def write_topic_preferences(user_id, topic_preferences):
         }
 
         # Update the topic preferences in the Elasticsearch index
-        response = es.update(index="users", id=user_id, body=body)
-        resp = es.indices.refresh(
-            index="users",
-        )
+        response = es.update(index="users", id=user_id, body=body, refresh=write_refresh())
         # Check the response from Elasticsearch
         if response['result'] in ['updated', 'created']:
             print(f"Topic preferences for user ID {user_id} successfully updated.")
@@ -365,10 +486,8 @@ def remove_fields_from_user(user_id, fields_to_remove):
         response = es.update(
             index="users",  # The index where your users are stored
             id=user_id,  # The unique identifier for the user
-            body={"script": script}
-        )
-        resp = es.indices.refresh(
-        index="users",
+            body={"script": script},
+            refresh=write_refresh()
         )
 
         # Check response for success
@@ -384,6 +503,19 @@ def remove_fields_from_user(user_id, fields_to_remove):
         return False
 
 
+def build_feedback_by_user_query(user_id):
+    """
+    Builds the query that matches all feedback entries of a user in the 'feedback' index.
+    """
+    return {
+        "query": {
+            "term": {
+                "userId.keyword": user_id  # Use the ".keyword" for exact match
+            }
+        }
+    }
+
+
 def get_all_feedback_by_user_id(user_id):
     """
     Retrieves all feedback entries for a specific user from the 'feedback' index.
@@ -396,20 +528,11 @@ def get_all_feedback_by_user_id(user_id):
     """
     feedback_entries = []
     try:
-        # Define the search query to filter by user ID
-        search_query = {
-            "query": {
-                "term": {
-                    "userId.keyword": user_id  # Use the ".keyword" for exact match
-                }
-            }
-        }
-
         # Initialize the scan operation
         feedback_scan = scan(
             client=es,
             index='feedback',
-            query=search_query,
+            query=build_feedback_by_user_query(user_id),
         )
 
         # Iterate over the scan results and collect feedback entries
@@ -454,13 +577,14 @@ def submit_video_feedback(user_id, video_id, rating):
             body={
                 "doc": feedback_doc,
                 "doc_as_upsert": True
-            }
-        )
-        resp = es.indices.refresh(
-        index="feedback",
+            },
+            refresh=write_refresh(searched=True)
         )
 
         print(f"Feedback submitted successfully: {response}")
+        # Imported here, exclusion_filter depends on this module
+        from Modules import exclusion_filter
+        exclusion_filter.add_excluded_videos(user_id, [video_id])
         return True
     except Exception as e:
         print(f"An error occurred while submitting feedback: {e}")
@@ -492,6 +616,8 @@ def remove_all_feedback_for_user(user_id):
 
         # Extract the number of deleted documents from the response
         num_deleted = response['deleted']
+        from Modules import exclusion_filter
+        exclusion_filter.invalidate(user_id)
         print(
             f"Successfully removed {num_deleted} feedback entries for user ID {user_id}.")
         return num_deleted
@@ -553,58 +679,26 @@ def similarity_search(topic_preferences, watched_videos, k):
 
 def load_topic_descriptions(index_name='topics'):
     """
-    Fetches topic descriptions from the Elasticsearch index.
+    Returns the topic descriptions from the in-process topic catalog.
 
     :param index_name: Name of the Elasticsearch index containing topics data.
     :return: A dictionary mapping each topic number to its description.
     """
+    from Modules import topic_catalog
 
-    # Prepare a search query to fetch all documents from the index
-    query = {
-        "size": 1000,  # Adjust this value based on the expected number of topics
-        "query": {
-            "match_all": {}
-        }
-    }
-
-    # Execute the search query
-    response = es.search(index=index_name, body=query)
-    
-    # Parse the response to extract topic descriptions
-    topic_descriptions = {}
-    for hit in response['hits']['hits']:
-        topic_number = hit['_source'].get('topic_number')  # Adjust field name as necessary
-        description = hit['_source'].get('description')
-        if topic_number is not None and description is not None:
-            topic_descriptions[topic_number] = description
-
-    return topic_descriptions
+    return topic_catalog.get_descriptions()
     
 
 def get_topic_description(topic_index):
     """
-    Fetches the description of a given topic index from the Elasticsearch 'topics' index.
+    Returns the description of a given topic index from the in-process topic catalog.
 
-    :param es: Elasticsearch client instance.
     :param topic_index: The index of the topic for which to fetch the description.
     :return: The description of the topic, or None if the topic is not found.
     """
-    query_body = {
-        "query": {
-            "term": {"topic_number": topic_index}
-        },
-        "size": 1
-    }
-    
-    # Assuming 'topics' is the name of your index containing the topic descriptions
-    response = es.search(index="topics", body=query_body)
-    
-    if response['hits']['total']['value'] > 0:
-        # Assuming there's only one document per topic index
-        description = response['hits']['hits'][0]['_source'].get('description', None)
-        return description
-    else:
-        return None
+    from Modules import topic_catalog
+
+    return topic_catalog.get_description(topic_index)
     
 
 def get_durations_bulk(video_ids):
@@ -671,25 +765,27 @@ def update_exploit_coeff(user_id, new_coeff):
                 "doc": {
                     "exploit_coeff": new_coeff
                 }
-            }
-        )
-        resp = es.indices.refresh(
-        index="users",
+            },
+            refresh=write_refresh()
         )
     except Exception as e:
         print(f"An error occurred: {e}")
 
 
-def read_disliked_video_ids(user_id):
+def read_disliked_video_ids(user_id, user_context=None):
     """
     Retrieves all video IDs from the 'disliked_creators_video_ids' field for a specified user in the 'users' index.
 
     Parameters:
     - user_id: The ID of the user whose complete list of disliked video IDs are to be retrieved.
+    - user_context: Optional UserContext of the user. If given, the field is read from it instead of the index.
 
     Returns:
     - A list of video IDs that the user has disliked, or an empty list if none are found.
     """
+    if user_context is not None:
+        return user_context.get('disliked_creators_video_ids', [])
+
     try:
         # Fetch the full document to ensure no API defaults limit our field data
         doc = es.get(index="users", id=user_id, _source="disliked_creators_video_ids")
@@ -0,0 +1,214 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from Modules import database_queries
+from config.settings import EXCLUSION_CACHE_TTL_SECONDS, EXCLUSION_CACHE_MAX_USERS
+
+
+class OrdinalBitmap:
+    """
+    Bit-packed set of video ordinals of a TopicVideoIndex, one bit per video.
+    """
+
+    def __init__(self, num_videos):
+        self.bits = np.zeros((num_videos + 7) // 8, dtype=np.uint8)
+
+    def add(self, ordinal):
+        self.bits[ordinal >> 3] |= np.uint8(1 << (ordinal & 7))
+
+    def add_all(self, ordinals):
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        np.bitwise_or.at(self.bits, ordinals >> 3, (1 << (ordinals & 7)).astype(np.uint8))
+
+    def __contains__(self, ordinal):
+        return bool(self.bits[ordinal >> 3] & (1 << (ordinal & 7)))
+
+
+class UserExclusions:
+    """
+    The videos that must not be recommended to a user: the videos the user gave feedback on and
+    the videos of disliked creators.
+
+    video_ids and channel_ids hold the excluded videos and channels, bitmap() the videos of both over the
+    ordinals of a TopicVideoIndex. They are kept up to date by add() and add_channels() as new feedback arrives.
+    """
+
+    def __init__(self, video_ids, channel_ids=()):
+        self.video_ids = set(video_ids)
+        self.channel_ids = set(channel_ids)
+        self.loaded_at = time.time()
+        self._lock = threading.Lock()
+        self._bitmap = None
+        self._bitmap_index = None
+
+    def add(self, video_ids):
+        with self._lock:
+            self.video_ids.update(video_ids)
+            if self._bitmap is not None:
+                self._mark(self._bitmap, self._bitmap_index, video_ids)
+
+    def add_channels(self, channel_ids):
+        with self._lock:
+            self.channel_ids.update(channel_ids)
+            if self._bitmap is not None:
+                self._mark_channels(self._bitmap, self._bitmap_index, channel_ids)
+
+    def bitmap(self, index):
+        """
+        Returns the exclusions as an OrdinalBitmap over the ordinals of the given TopicVideoIndex.
+        The bitmap is built once per index and then updated incrementally.
+        """
+        with self._lock:
+            if self._bitmap_index is not index:
+                self._bitmap = OrdinalBitmap(len(index.video_ids))
+                self._bitmap_index = index
+                self._mark(self._bitmap, index, self.video_ids)
+                self._mark_channels(self._bitmap, index, self.channel_ids)
+            return self._bitmap
+
+    @staticmethod
+    def _mark(bitmap, index, video_ids):
+        for video_id in video_ids:
+            ordinal = index.ordinal_of.get(video_id)
+            if ordinal is not None:
+                bitmap.add(ordinal)
+
+    @staticmethod
+    def _mark_channels(bitmap, index, channel_ids):
+        for channel_id in channel_ids:
+            bitmap.add_all(index.ordinals_of_channel(channel_id))
+
+
+# Process-wide cache of the exclusions of the most recently active users
+_exclusions = OrderedDict()
+_lock = threading.Lock()
+# Users whose feedback is being read from Elasticsearch, with the number of changes (added exclusions or
+# invalidations) since the read started. A read that missed a change is not cached.
+_loading = {}
+# Number of reads of the feedback of a user before the exclusions are used without caching them
+MAX_LOAD_ATTEMPTS = 3
+
+
+def get_cached_exclusions(user_id):
+    """
+    Returns the cached exclusions of the user, or None if they are not cached or older than EXCLUSION_CACHE_TTL_SECONDS.
+    """
+    with _lock:
+        exclusions = _exclusions.get(user_id)
+        if exclusions is None:
+            return None
+        if time.time() - exclusions.loaded_at >= EXCLUSION_CACHE_TTL_SECONDS:
+            del _exclusions[user_id]
+            return None
+        _exclusions.move_to_end(user_id)
+        return exclusions
+
+
+def store_exclusions(user_id, watched_video_ids, disliked_video_ids, disliked_channel_ids=(), version=None,
+                     cache=True):
+    """
+    Caches the exclusions of the user, evicting the least recently used users beyond EXCLUSION_CACHE_MAX_USERS.
+
+    :param version: Version returned by start_loading before the exclusions were read. If the exclusions of the
+                    user changed since then, they are not stored and None is returned, the caller reads them again.
+    :param cache: False to return the exclusions without storing them, even if they changed in the meantime
+                  (used after MAX_LOAD_ATTEMPTS reads of a user whose feedback keeps changing).
+    :return: The UserExclusions, or None if they may be stale.
+    """
+    exclusions = UserExclusions(set(watched_video_ids).union(disliked_video_ids), disliked_channel_ids)
+    with _lock:
+        if version is not None:
+            unchanged = _loading.pop(user_id, None) == version
+            if not cache:
+                return exclusions
+            if not unchanged:
+                return None
+        _exclusions[user_id] = exclusions
+        _exclusions.move_to_end(user_id)
+        while len(_exclusions) > EXCLUSION_CACHE_MAX_USERS:
+            _exclusions.popitem(last=False)
+    return exclusions
+
+
+def get_exclusions(user_id, user_context):
+    """
+    Returns the exclusions of the user, reading the user's feedback from Elasticsearch only if they are not cached.
+
+    :param user_id: The ID of the user.
+    :param user_context: UserContext of the user, used for the disliked creators.
+    :return: UserExclusions of the user.
+    """
+    exclusions = get_cached_exclusions(user_id)
+    attempts = 0
+    while exclusions is None:
+        attempts += 1
+        version = start_loading(user_id)
+        try:
+            feedback_entries = database_queries.get_all_feedback_by_user_id(user_id)
+            # Video IDs of disliked creators stored by earlier versions
+            disliked_video_ids = database_queries.read_disliked_video_ids(user_id=user_id, user_context=user_context)
+        except Exception:
+            abandon_loading(user_id)
+            raise
+        exclusions = store_exclusions(user_id, [feedback['videoId'] for feedback in feedback_entries],
+                                      disliked_video_ids, user_context.get('disliked_creators') or [],
+                                      version=version, cache=attempts < MAX_LOAD_ATTEMPTS)
+    return exclusions
+
+
+def start_loading(user_id):
+    """
+    Marks the exclusions of the user as being read from Elasticsearch and returns their version. Pass it to
+    store_exclusions, which refuses to cache the exclusions if feedback was recorded in the meantime, since the
+    read may have missed it.
+    """
+    with _lock:
+        return _loading.setdefault(user_id, 0)
+
+
+def abandon_loading(user_id):
+    """
+    Ends a read started with start_loading without storing its result.
+    """
+    with _lock:
+        _loading.pop(user_id, None)
+
+
+def _changed(user_id):
+    # Must be called with _lock held
+    if user_id in _loading:
+        _loading[user_id] += 1
+
+
+def add_excluded_videos(user_id, video_ids):
+    """
+    Adds newly watched or disliked videos to the cached exclusions of the user, if they are cached.
+    """
+    with _lock:
+        exclusions = _exclusions.get(user_id)
+        _changed(user_id)
+    if exclusions is not None:
+        exclusions.add(video_ids)
+
+
+def add_excluded_channels(user_id, channel_ids):
+    """
+    Adds newly disliked creators to the cached exclusions of the user, if they are cached.
+    """
+    with _lock:
+        exclusions = _exclusions.get(user_id)
+        _changed(user_id)
+    if exclusions is not None:
+        exclusions.add_channels(channel_ids)
+
+
+def invalidate(user_id):
+    """
+    Drops the cached exclusions of the user, e.g. after the user's feedback has been deleted.
+    """
+    with _lock:
+        _exclusions.pop(user_id, None)
+        _changed(user_id)
@@ -0,0 +1,80 @@
+import atexit
+import queue
+import threading
+import zlib
+
+
+class KeyedJobQueue:
+    """
+    Local job queue that runs jobs on a pool of worker threads, in order per key.
+
+    Every key (e.g. a user ID) is always handled by the same worker, so the jobs of one key run one
+    after another in the order they were submitted while jobs of different keys run in parallel.
+    A job that is submitted while the same job of the same key is still waiting is coalesced with it,
+    since the waiting job will see the latest state anyway.
+    """
+
+    def __init__(self, num_workers=4, name='jobs'):
+        self.name = name
+        self._queues = [queue.Queue() for _ in range(num_workers)]
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._workers = []
+        for worker_id, worker_queue in enumerate(self._queues):
+            worker = threading.Thread(target=self._run, args=(worker_queue,), name=f'{name}-{worker_id}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        atexit.register(self.shutdown)
+
+    def submit(self, key, job_name, function, *args, **kwargs):
+        """
+        Schedules function(*args, **kwargs) to run after the previously submitted jobs of the key.
+
+        :param key: Key that determines the ordering, e.g. the user ID.
+        :param job_name: Name of the job, used to coalesce it with the same waiting job of the key.
+        :return: True if the job was scheduled, False if it was coalesced with a waiting job.
+        """
+        job_id = (key, job_name)
+        with self._pending_lock:
+            if job_id in self._pending:
+                return False
+            self._pending.add(job_id)
+        self._queue_of(key).put((job_id, function, args, kwargs))
+        return True
+
+    def join(self):
+        """
+        Blocks until all submitted jobs have run.
+        """
+        for worker_queue in self._queues:
+            worker_queue.join()
+
+    def shutdown(self):
+        """
+        Runs the remaining jobs and stops the workers.
+        """
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _queue_of(self, key):
+        # Stable hash, independent of PYTHONHASHSEED
+        return self._queues[zlib.crc32(str(key).encode('utf-8')) % len(self._queues)]
+
+    def _run(self, worker_queue):
+        while True:
+            job = worker_queue.get()
+            try:
+                if job is None:
+                    return
+                job_id, function, args, kwargs = job
+                # From now on, a new submission of the job has to run again
+                with self._pending_lock:
+                    self._pending.discard(job_id)
+                try:
+                    function(*args, **kwargs)
+                except Exception as e:
+                    print(f"An error occurred while running job {job_id} of '{self.name}': {e}")
+            finally:
+                worker_queue.task_done()
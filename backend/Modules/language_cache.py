@@ -0,0 +1,47 @@
+import threading
+
+from langdetect import DetectorFactory, detect, LangDetectException
+
+from Modules.sqlite_cache import SqliteCache, text_hash
+from config.settings import LANGUAGE_CACHE_PATH
+
+# Deterministic predictions, so that cached languages do not depend on the code path that detected them
+DetectorFactory.seed = 0
+
+
+def detect_language(text):
+    """
+    Predicts the language of a text, '' if it cannot be detected.
+    """
+    try:
+        return detect(text)
+    except LangDetectException:
+        return ''
+
+
+class LanguageCache(SqliteCache):
+    """
+    Persistent SQLite cache of predicted languages, keyed by the content hash of the text (see text_hash).
+    A video is only run through language detection (see detect_language) again when its title or description
+    changes.
+    Texts whose language could not be detected are cached with the language ''.
+    """
+
+    def __init__(self, path):
+        super().__init__(path, 'languages', value_column='language')
+
+
+# Process-wide cache, see get_cache
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the language cache at LANGUAGE_CACHE_PATH, opening it on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LanguageCache(LANGUAGE_CACHE_PATH)
+        return _cache
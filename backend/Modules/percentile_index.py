@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+import config.settings
+from config.settings import TOPIC_MODELING_RUNS_DIR
+
+# File written to the run directory by build_percentile_index
+PERCENTILE_INDEX_FILE = 'percentile_index.npz'
+
+
+class PercentileIndex:
+    """
+    In-memory copy of the 'most_relevant_topics_dict' fields of the 'topic_distributions' index for the
+    candidate search of the personalised RS.
+
+    Every video gets an ordinal (its position in video_ids). The videos are sorted by most relevant topic and
+    percentile, so that the videos of a topic are the slice topic_offsets[topic]:topic_offsets[topic + 1] of
+    the sorted arrays and a percentile window within it is found by binary search.
+    """
+
+    def __init__(self, video_ids, first_topics, percentiles, first_scores, second_topics, second_scores):
+        self.video_ids = list(video_ids)
+        self.ordinal_of = {video_id: ordinal for ordinal, video_id in enumerate(self.video_ids)}
+        self.first_topics = np.asarray(first_topics, dtype=np.int32)
+        self.percentiles = np.asarray(percentiles, dtype=np.float64)
+        self.first_scores = np.asarray(first_scores, dtype=np.float64)
+        self.second_topics = np.asarray(second_topics, dtype=np.int32)
+        self.second_scores = np.asarray(second_scores, dtype=np.float64)
+
+        ordinals = np.arange(len(self.video_ids), dtype=np.int32)
+        self.sorted_ordinals = np.lexsort((ordinals, self.percentiles, self.first_topics)).astype(np.int32)
+        self.sorted_percentiles = self.percentiles[self.sorted_ordinals]
+        self.sorted_second_topics = self.second_topics[self.sorted_ordinals]
+        num_topics = int(self.first_topics.max()) + 1 if len(self.first_topics) else 0
+        self.topic_offsets = np.zeros(num_topics + 1, dtype=np.int64)
+        self.topic_offsets[1:] = np.cumsum(np.bincount(self.first_topics, minlength=num_topics))
+
+    def save(self, path):
+        np.savez(path, video_ids=np.asarray(self.video_ids), first_topics=self.first_topics,
+                 percentiles=self.percentiles, first_scores=self.first_scores,
+                 second_topics=self.second_topics, second_scores=self.second_scores)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['video_ids'].tolist(), data['first_topics'], data['percentiles'], data['first_scores'],
+                       data['second_topics'], data['second_scores'])
+
+    def search(self, percentile_window, most_relevant_topics, second_most_relevant_topics, exclude_video_ids, size=10):
+        """
+        Same filter as personalised_rs_database_queries.execute_query: the videos whose most relevant topic is one
+        of most_relevant_topics with a percentile within the window, and whose second most relevant topic is one
+        of second_most_relevant_topics.
+
+        :param percentile_window: Tuple with the lower and upper bounds (inclusive) of the percentile window.
+        :param exclude_video_ids: Iterable of video IDs to skip.
+        :param size: Maximum number of videos to return.
+        :return: Tuple (ordinals of at most size videos in ordinal order, total number of matching videos).
+        """
+        lower, upper = percentile_window
+        second_topics = np.asarray(list(second_most_relevant_topics), dtype=np.int32)
+        excluded = np.array(sorted({self.ordinal_of[video_id] for video_id in exclude_video_ids
+                                    if video_id in self.ordinal_of}), dtype=np.int32)
+
+        matches = []
+        for topic in set(most_relevant_topics):
+            topic = int(topic)
+            if not 0 <= topic < len(self.topic_offsets) - 1:
+                continue
+            start, end = self.topic_offsets[topic], self.topic_offsets[topic + 1]
+            window_start = start + np.searchsorted(self.sorted_percentiles[start:end], lower, side='left')
+            window_end = start + np.searchsorted(self.sorted_percentiles[start:end], upper, side='right')
+            ordinals = self.sorted_ordinals[window_start:window_end]
+            mask = np.isin(self.sorted_second_topics[window_start:window_end], second_topics)
+            if len(excluded):
+                mask &= ~np.isin(ordinals, excluded, assume_unique=True)
+            matches.append(ordinals[mask])
+
+        if not matches:
+            return [], 0
+        matches = np.sort(np.concatenate(matches))
+        return matches[:size].tolist(), len(matches)
+
+    def search_response(self, percentile_window, most_relevant_topics, second_most_relevant_topics, exclude_video_ids,
+                        size=10):
+        """
+        Runs search() and returns the result in the shape of the response to
+        personalised_rs_database_queries.execute_query.
+        """
+        ordinals, total = self.search(percentile_window, most_relevant_topics, second_most_relevant_topics,
+                                      exclude_video_ids, size=size)
+        hits = [{
+            "_id": self.video_ids[ordinal],
+            "_source": {
+                "id": self.video_ids[ordinal],
+                "most_relevant_topics_dict": {
+                    "1": {"topic_index": int(self.first_topics[ordinal]),
+                          "topic_score": float(self.first_scores[ordinal]),
+                          "percentile": float(self.percentiles[ordinal])},
+                    "2": {"topic_index": int(self.second_topics[ordinal]),
+                          "topic_score": float(self.second_scores[ordinal])}
+                }
+            }
+        } for ordinal in ordinals]
+        return {"hits": {"total": {"value": total}, "hits": hits}}
+
+
+def build_percentile_index(run_dir):
+    """
+    Reads the refined topic distributions of a run (topic_distributions_refined.json, see
+    personalised_rs_topic_distributions_management.process_topic_distributions) and saves the
+    percentile index into the run directory.
+
+    :return: The PercentileIndex.
+    """
+    video_ids, first_topics, percentiles, first_scores, second_topics, second_scores = [], [], [], [], [], []
+    with open(os.path.join(run_dir, 'topic_distributions_refined.json'), 'r') as file:
+        for line in file:
+            video = json.loads(line)
+            first = video['most_relevant_topics_dict']['1']
+            second = video['most_relevant_topics_dict']['2']
+            video_ids.append(video['id'])
+            first_topics.append(first['topic_index'])
+            percentiles.append(first['percentile'])
+            first_scores.append(first['topic_score'])
+            second_topics.append(second['topic_index'])
+            second_scores.append(second['topic_score'])
+
+    index = PercentileIndex(video_ids, first_topics, percentiles, first_scores, second_topics, second_scores)
+    index.save(os.path.join(run_dir, PERCENTILE_INDEX_FILE))
+    print(f"Percentile index: wrote {len(video_ids)} videos to {run_dir}.")
+    return index
+
+
+# Index of the topic modeling run in the database, see get_index
+_index = None
+_index_run_id = None
+_lock = threading.Lock()
+
+
+def get_index(run_id=None):
+    """
+    Returns the percentile index of the given run (default: tm_run_in_database), loading it on first use.
+    Runs refined before the index existed get their index built from topic_distributions_refined.json.
+
+    :return: A PercentileIndex, or None if the run has no refined topic distributions.
+    """
+    global _index, _index_run_id
+    if run_id is None:
+        run_id = config.settings.tm_run_in_database
+    with _lock:
+        if _index_run_id != run_id:
+            run_dir = os.path.join(TOPIC_MODELING_RUNS_DIR, run_id)
+            _index = None
+            try:
+                if os.path.exists(os.path.join(run_dir, PERCENTILE_INDEX_FILE)):
+                    _index = PercentileIndex.load(os.path.join(run_dir, PERCENTILE_INDEX_FILE))
+                elif os.path.exists(os.path.join(run_dir, 'topic_distributions_refined.json')):
+                    _index = build_percentile_index(run_dir)
+                else:
+                    print(f"Percentile index: no refined topic distributions in run '{run_id}'.")
+            except Exception as e:
+                print(f"An error occurred while loading the percentile index of run '{run_id}': {e}")
+            _index_run_id = run_id
+        return _index
@@ -2,8 +2,9 @@ import sys
 sys.path.append('/Users/pablojerezarnau/git/RS-backend/')
 
 from Modules import topic_preferences_management, personalised_rs_database_queries, database_queries
-from Modules import rs_logic
+from Modules import rs_logic, percentile_index
 from Modules.database_queries import es
+import config.settings
 
 def update_topic_ratings(user_id, n_liked_topics=10):
     """
@@ -193,11 +194,18 @@ def get_recommendations(user_id, n_recs):
 
     
 
-    # Perform query
-    query_results = personalised_rs_database_queries.execute_query(percentile_window=percentile_bounds,
-                                                                   most_relevant_topics=most_relevant_topics,
-                                                                   second_most_relevant_topics=second_most_relevant_topics,
-                                                                   exclude_video_ids=watched_videos_ids)
+    # Perform query, in memory if the percentile index of the run in the database is available
+    index = percentile_index.get_index() if config.settings.PERCENTILE_INDEX_ENABLED else None
+    if index is not None:
+        query_results = index.search_response(percentile_window=percentile_bounds,
+                                              most_relevant_topics=most_relevant_topics,
+                                              second_most_relevant_topics=second_most_relevant_topics,
+                                              exclude_video_ids=watched_videos_ids)
+    else:
+        query_results = personalised_rs_database_queries.execute_query(percentile_window=percentile_bounds,
+                                                                       most_relevant_topics=most_relevant_topics,
+                                                                       second_most_relevant_topics=second_most_relevant_topics,
+                                                                       exclude_video_ids=watched_videos_ids)
     
     # Optional: pretty print info of recommended videos
     pretty_print_query_results(results=query_results, n_recs=n_recs)
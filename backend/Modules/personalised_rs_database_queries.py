@@ -1,7 +1,7 @@
 import sys
 sys.path.append('/Users/pablojerezarnau/git/RS-backend/')
 
-from Modules.database_queries import es
+from Modules.database_queries import es, write_refresh
 
 
 def upload_topic_ratings(user_id, topic_ratings):
@@ -24,10 +24,7 @@ def upload_topic_ratings(user_id, topic_ratings):
         }
 
         # Update the user document with the new topic ratings
-        response = es.update(index="users", id=user_id, body=update_body)
-        resp = es.indices.refresh(
-            index="users",
-        )
+        response = es.update(index="users", id=user_id, body=update_body, refresh=write_refresh())
         # Check if the update was successful
         if response['result'] in ['updated', 'noop']:
             return f"Topic ratings for user {user_id} updated successfully."
@@ -1,85 +1,127 @@
 import sys
 sys.path.append('/Users/pablojerezarnau/git/RS-backend/')
 
-from Modules.database_queries import es, helpers
+from Modules import database_queries, percentile_index
 import json, os
-from collections import defaultdict
+import numpy as np
 from config.settings import TOPIC_MODELING_RUNS_DIR 
 
 
-def process_topic_distributions(run_id):
+def _top_topics(distributions, n=5):
+    """
+    Returns the indices of the n highest scored topics of every row, highest first. Equal scores are ordered
+    by topic index, like a stable sort of the scores in descending order.
+    """
+    top = np.argpartition(-distributions, n - 1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(distributions, top, axis=1)
+
+    # Rows where more than n topics tie with the n-th highest score may have picked the wrong topics
+    nth_scores = top_scores.min(axis=1, keepdims=True)
+    ties = np.flatnonzero((distributions >= nth_scores).sum(axis=1) > n)
+    if len(ties):
+        top[ties] = np.argsort(-distributions[ties], axis=1, kind='stable')[:, :n]
+        top_scores[ties] = np.take_along_axis(distributions[ties], top[ties], axis=1)
+
+    # Order the n topics by score (descending), then by topic index
+    order = np.lexsort((top, -top_scores), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def process_topic_distributions(run_id, batch_size=65536):
     """
     Processes topic distributions for a given run ID. Calculates the most relevant topics and their percentiles,
     then stores this data in two different formats: 'most_relevant_topics_dict' with percentile info of the most
     relevant one, and 'most_relevant_topics' as a list of dicts with top-3 topics and their scores.
-    The processed data is stored as 'topic_distributions_refined.json' in the run directory.
+    The processed data is stored as 'topic_distributions_refined.json' in the run directory, together with
+    the percentile index of the personalised RS (see percentile_index).
+
+    The distributions are read into one matrix and the top topics and percentiles are computed with NumPy.
+    The refined videos are then written line by line, serialising each distribution from its matrix row.
 
     :param run_id: The ID of the topic modeling run.
-    :param TOPIC_MODELING_RUNS_DIR: The base directory containing topic modeling runs.
+    :param batch_size: Number of videos whose top topics are computed at once.
     """
-    file_path = os.path.join(TOPIC_MODELING_RUNS_DIR, f"{run_id}/topic_distributions.json")
-    file_out_path = os.path.join(TOPIC_MODELING_RUNS_DIR, f"{run_id}/topic_distributions_refined.json")
+    run_dir = os.path.join(TOPIC_MODELING_RUNS_DIR, run_id)
+    file_path = os.path.join(run_dir, "topic_distributions.json")
+    file_out_path = os.path.join(run_dir, "topic_distributions_refined.json")
 
-    # Step 1: Load videos
-    videos = []
+    # Step 1: Load the topic distributions into a matrix
+    num_videos = 0
+    num_topics = 0
     with open(file_path, 'r') as file:
         for line in file:
-            videos.append(json.loads(line))
-
-    # Step 2: Prepare data structure for percentile calculation
-    topic_videos = defaultdict(list)
-    for video in videos:
-        topic_distribution = video['topic_distribution']
-        top_indices_scores = sorted(enumerate(topic_distribution), key=lambda x: x[1], reverse=True)[:5]
-        most_relevant_topic = top_indices_scores[0][0]
-        video['top_topics_info'] = [{'topic_index': index, 'topic_score': score} for index, score in top_indices_scores]
-        topic_videos[most_relevant_topic].append(video)
-
-    # Step 3: Calculate percentiles for each topic
-    for topic, vids in topic_videos.items():
-        vids_sorted = sorted(vids, key=lambda x: x['topic_distribution'][topic], reverse=True)
-        for i, video in enumerate(vids_sorted):
-            percentile = (i / len(vids_sorted)) * 100
-            video['percentile'] = percentile
-
-    # Step 4: Update videos with enriched most_relevant_topics
-    for video in videos:
-        enriched_most_relevant_topics_dict = {}
-        most_relevant_topics = []
-        for rank, topic_info in enumerate(video['top_topics_info'], start=1):
-            if rank == 1:
-                topic_info['percentile'] = video['percentile']
-            enriched_most_relevant_topics_dict[str(rank)] = topic_info
-            if rank <= 3:  # Collect top-3 topics for the new 'most_relevant_topics'
-                most_relevant_topics.append({'topic_index': topic_info['topic_index'], 'score': topic_info['topic_score']})
-        video['most_relevant_topics_dict'] = enriched_most_relevant_topics_dict
-        video['most_relevant_topics'] = most_relevant_topics
-        del video['percentile']  # Remove the temporary field
-        del video['top_topics_info']  # Remove the temporary field
-
-    # Step 5: Write the updated videos back to a new file
-    with open(file_out_path, 'w') as file:
-        for video in videos:
-            file.write(json.dumps(video) + '\n')
-    
+            if num_videos == 0:
+                num_topics = len(json.loads(line)['topic_distribution'])
+            num_videos += 1
+    # float64, so that the distributions and scores written back are exactly the ones that were read
+    distributions = np.empty((num_videos, num_topics), dtype=np.float64)
+    # The other fields of the videos, with the distribution left out to keep them small
+    videos = []
+    with open(file_path, 'r') as file:
+        for row, line in enumerate(file):
+            video = json.loads(line)
+            distributions[row] = video['topic_distribution']
+            video['topic_distribution'] = None  # Keeps the position of the key
+            videos.append(video)
+
+    # Step 2: Top-5 topics of every video (all topics if the run has fewer)
+    num_top_topics = min(5, num_topics)
+    top_topics = np.empty((num_videos, num_top_topics), dtype=np.int64)
+    for start in range(0, num_videos, batch_size):
+        top_topics[start:start + batch_size] = _top_topics(distributions[start:start + batch_size], n=num_top_topics)
+    top_scores = np.take_along_axis(distributions, top_topics, axis=1)
+
+    # Step 3: Percentile of every video among the videos with the same most relevant topic,
+    # ranked by the score of that topic (descending) and then by position in the file
+    most_relevant_topic = top_topics[:, 0]
+    ordinals = np.arange(num_videos)
+    order = np.lexsort((ordinals, -top_scores[:, 0], most_relevant_topic))
+    counts = np.bincount(most_relevant_topic, minlength=num_topics)
+    group_starts = np.cumsum(counts) - counts
+    ranks = np.empty(num_videos, dtype=np.int64)
+    ranks[order] = ordinals - group_starts[most_relevant_topic[order]]
+    percentiles = (ranks / counts[most_relevant_topic]) * 100
+
+    # Step 4: Write the videos with the enriched most_relevant_topics to a new file
+    video_ids = []
+    with open(file_out_path, 'w') as file_out:
+        for row, video in enumerate(videos):
+            video['topic_distribution'] = distributions[row].tolist()
+            enriched_most_relevant_topics_dict = {}
+            most_relevant_topics = []
+            for rank in range(1, num_top_topics + 1):
+                topic_info = {'topic_index': int(top_topics[row, rank - 1]),
+                              'topic_score': float(top_scores[row, rank - 1])}
+                if rank == 1:
+                    topic_info['percentile'] = float(percentiles[row])
+                enriched_most_relevant_topics_dict[str(rank)] = topic_info
+                if rank <= 3:  # Collect top-3 topics for the new 'most_relevant_topics'
+                    most_relevant_topics.append({'topic_index': topic_info['topic_index'], 'score': topic_info['topic_score']})
+            video['most_relevant_topics_dict'] = enriched_most_relevant_topics_dict
+            video['most_relevant_topics'] = most_relevant_topics
+            file_out.write(json.dumps(video) + '\n')
+            video_ids.append(video['id'])
+            videos[row] = None
+
+    # Step 5: Save the percentile index of the personalised RS
+    index = percentile_index.PercentileIndex(video_ids, top_topics[:, 0], percentiles, top_scores[:, 0],
+                                             top_topics[:, 1], top_scores[:, 1])
+    index.save(os.path.join(run_dir, percentile_index.PERCENTILE_INDEX_FILE))
+    print(f"Refined the topic distributions of {num_videos} videos of run '{run_id}'.")
 
 
 def update_topic_distributions_pipeline(run_id):
     """
     Orchestrates the pipeline for updating topic distributions within an Elasticsearch index.
-    This involves processing the topic distributions to calculate percentiles, removing old entries from
-    the index, and uploading the refined data.
+    This involves processing the topic distributions to calculate percentiles and publishing the refined
+    data as a new index behind the 'topic_distributions' alias (see database_queries.publish_topic_distributions).
 
     :param run_id: The unique identifier for the topic modeling run.
     """
     # Step 1: Process topic distributions and save the refined data
     process_topic_distributions(run_id)
-    
-    # Step 2: Remove existing entries from the Elasticsearch index
-    query = {"query": {"match_all": {}}}
-    es.delete_by_query(index="topic_distributions", body=query)
-    
-    # Step 3: Upload the refined topic distributions to the Elasticsearch index
+
+    # Step 2: Upload the refined topic distributions to a new index and swap it in
     file_path = os.path.join(TOPIC_MODELING_RUNS_DIR, f"{run_id}/topic_distributions_refined.json")
 
     # Generator function to read and yield documents from the file
@@ -87,13 +129,9 @@ def update_topic_distributions_pipeline(run_id):
         with open(file_path, 'r') as file:
             for line in file:
                 doc = json.loads(line)
-                yield {
-                    "_index": "topic_distributions",
-                    "_id": doc["id"],  # Assuming each document has a unique 'id' field
-                    "_source": doc
-                }
-    
-    # Use the bulk helper to upload
-    helpers.bulk(es, generate_data())
-    
-    print("Topic distributions pipeline completed.")
\ No newline at end of file
+                yield doc["id"], doc  # Assuming each document has a unique 'id' field
+
+    if database_queries.publish_topic_distributions(run_id, generate_data()):
+        print("Topic distributions pipeline completed.")
+    else:
+        print("Topic distributions pipeline failed, the previous topic distributions are still published.")
@@ -4,6 +4,7 @@ sys.path.append('/Users/pablojerezarnau/git/RS-backend/')
 from Modules import database,topic_preferences_management, database_queries, helper_functions, topic_categories_management, additional_rating_options
 import numpy as np
 from Modules.database_queries import es
+from Modules.user_context import UserContext
 import config
 
 
@@ -212,9 +213,10 @@ def update_with_feedback(topic_preferences, feedback):
 
 
 
-def update_topic_preferences_from_feedback(user_id, feedback_list,user_data):
+def update_topic_preferences_from_feedback(user_id, feedback_list,user_data,user_context=None):
     """
     Given the list of feedback entries, update the user's toic_preferences.
+    Changes to other user fields are recorded in user_context, if given.
     """
     print(f'feedback_list: {feedback_list}')
 
@@ -243,9 +245,9 @@ def update_topic_preferences_from_feedback(user_id, feedback_list,user_data):
             # print(f'Fedback n. {idx}. topic_preferencse: {topic_preferences}')
 
         # Process the feedback field 'dislikeReasons'
-        additional_rating_options.process_disliked_creators(feedback_list, user_id)
+        additional_rating_options.process_disliked_creators(feedback_list, user_id, user_context=user_context)
 
-        additional_rating_options.process_too_much_similar_content(feedback_list, user_id)
+        additional_rating_options.process_too_much_similar_content(feedback_list, user_id, user_context=user_context)
 
         # 6. Normalise topic_preferences
         print(f'Feedback processing - Normalising updated_topic_preferences')
@@ -255,24 +257,28 @@ def update_topic_preferences_from_feedback(user_id, feedback_list,user_data):
         return topic_preferences
 
 
-def process_feedback(feedback_list):
+def process_feedback(feedback_list, user_context=None):
     """
     Orchestrate the processing of a list of feedback elements. Triggered by the 
     POST request /feedback.
+    The user document is read once (or taken from user_context) and all changes are committed in one update.
     """
     if feedback_list:
         user_id = feedback_list[0]['userId']
     else:
         return "No valid userId given."
 
-    user_data = database.findByUserId(user_id)
+    if user_context is None:
+        user_context = UserContext.load(user_id)
+    user_data = user_context.source if user_context is not None else None
     
     if user_data and 'topic_preferences' in user_data:
         # 1. Update topic_preferences from feedback
         topic_preferences=update_topic_preferences_from_feedback(user_id=user_id,
-                                            feedback_list=feedback_list,user_data=user_data)
+                                            feedback_list=feedback_list,user_data=user_data,
+                                            user_context=user_context)
         
-        topic_categories = topic_categories_management.calculate_topic_categories(user_id)
+        topic_categories = topic_categories_management.calculate_topic_categories(user_id, user_context=user_context)
         # print(f'topic_categories: {topic_categories}')
 
 
@@ -287,29 +293,15 @@ def process_feedback(feedback_list):
         # 4. Update the field feedbackLastUsed in database
         timestamp=max([feedback['timestamp']for feedback in feedback_list])
         print(processed_topic_scores)
-        update_script = {
-            "script": {
-                "lang": "painless",
-                "source": "ctx._source.remove('topic_categories');ctx._source.topic_categories = params.topic_categories; \
-                           ctx._source.remove('processed_topic_scores');ctx._source.processed_topic_scores = params.processed_topic_scores; \
-                           ctx._source.remove('feedbackLastUsed');ctx._source.feedbackLastUsed= params.feedbackLastUsed; \
-                            ctx._source.remove('topic_preferences');ctx._source.topic_preferences = params.topic_preferences; ",
-                "params": {
-                    "topic_categories": topic_categories,
-                    "processed_topic_scores": processed_topic_scores,
-                    "feedbackLastUsed": timestamp,
-                    "topic_preferences": topic_preferences
-                }
-            }
-        }
+        user_context.set(topic_categories=topic_categories,
+                         processed_topic_scores=processed_topic_scores,
+                         feedbackLastUsed=timestamp,
+                         topic_preferences=topic_preferences)
         print(timestamp)
 
         try:
-            # Execute the update operation with the script
-            response = es.update(index="users", id=user_id, body=update_script)
-            resp = es.indices.refresh(
-            index="users",
-        )
+            # Write all pending changes of the user with a single update
+            response = user_context.commit()
             print(response)
             print(f"Updated user {user_id} with new processed_topic_scores.")
         except Exception as e:
@@ -0,0 +1,75 @@
+from Modules import topic_catalog
+from Modules.database_queries import es
+from config.settings import VIDEO_CARD_FIELDS
+
+
+def build_enrichment_request(video_ids, include_videos=True):
+    """
+    Builds a single multi-index _mget body that fetches the video card (if include_videos) and the
+    most relevant topics of every given video.
+
+    :param video_ids: List of video IDs in the order of the recommendations.
+    :param include_videos: Whether to fetch the video documents from the 'videos' index as well.
+    :return: The body for es.mget.
+    """
+    docs = []
+    for video_id in video_ids:
+        if include_videos:
+            docs.append({"_index": "videos", "_id": video_id, "_source": VIDEO_CARD_FIELDS})
+        docs.append({"_index": "topic_distributions", "_id": video_id, "_source": ["most_relevant_topics"]})
+    return {"docs": docs}
+
+
+def topics_from_distribution(topic_distribution):
+    """
+    Joins the most relevant topics of a 'topic_distributions' document with the cached topic descriptions.
+
+    :param topic_distribution: The _source of a 'topic_distributions' document, or None.
+    :return: List of dicts with 'id', 'description' and 'score' of each topic.
+    """
+    topics = []
+    if not topic_distribution:
+        return topics
+    for topic_score in topic_distribution.get('most_relevant_topics', []):
+        topic_index = topic_score['topic_index']
+        topics.append({
+            "id": topic_index,
+            "description": topic_catalog.get_description(topic_index),
+            "score": topic_score.get('score', topic_score.get('topic_score'))
+        })
+    return topics
+
+
+def apply_enrichment(recommendations, response, include_videos=True):
+    """
+    Adds the fields 'video' (if include_videos) and 'topics' to each recommendation from the response
+    to a request built by build_enrichment_request.
+    """
+    docs = response['docs']
+    docs_per_recommendation = 2 if include_videos else 1
+    for position, recommendation in enumerate(recommendations):
+        recommendation_docs = docs[position * docs_per_recommendation:(position + 1) * docs_per_recommendation]
+        if include_videos:
+            video_doc = recommendation_docs[0]
+            recommendation["video"] = video_doc['_source'] if video_doc.get('found') else None
+        topic_distribution_doc = recommendation_docs[-1]
+        topic_distribution = topic_distribution_doc['_source'] if topic_distribution_doc.get('found') else None
+        recommendation["topics"] = topics_from_distribution(topic_distribution)
+    return recommendations
+
+
+def enrich_recommendations(recommendations, include_videos=True):
+    """
+    Adds the video card and the described most relevant topics to each recommendation
+    with a single round trip to Elasticsearch.
+
+    :param recommendations: List of recommendation dicts with a 'videoId' key.
+    :param include_videos: Whether to fetch the video card as well, e.g. False if it is already present.
+    :return: The enriched list of recommendations.
+    """
+    if not recommendations:
+        return recommendations
+    body = build_enrichment_request([recommendation["videoId"] for recommendation in recommendations],
+                                    include_videos=include_videos)
+    response = es.mget(body=body)
+    return apply_enrichment(recommendations, response, include_videos=include_videos)
@@ -3,6 +3,8 @@ sys.path.append('/Users/pablojerezarnau/git/RS-backend/')
 
 from Modules import helper_functions,database_queries, topic_preferences_management, new_personalised_rs, topic_categories_management
 from Modules.topic_preferences_management import database_queries
+from Modules.user_context import UserContext
+from Modules import topic_video_index, exclusion_filter
 import random
 from config.settings import num_topics_in_database
 import config
@@ -13,7 +15,11 @@ from Modules.database_queries import es
 num_topics_in_database = 300
     
 
-def seachTopic(topics,excluded_videos):
+def build_topic_query(topics,excluded_videos,excluded_channels=()):
+    """
+    Builds the search body for the most viewed videos whose most relevant topic is one of the given topics,
+    returning one video per entry in topics. Videos of the excluded channels are skipped as well.
+    """
     query = {
         "query": {
             "bool": {
@@ -22,11 +28,18 @@ def seachTopic(topics,excluded_videos):
                         "most_relevant_topic": topics
                     }
                 },
-                "must_not": {
-                    "ids": {
-                        "values": excluded_videos # List of video IDs to exclude
+                "must_not": [
+                    {
+                        "ids": {
+                            "values": excluded_videos # List of video IDs to exclude
+                        }
+                    },
+                    {
+                        "terms": {
+                            "snippet.channelId.keyword": list(excluded_channels) # List of disliked creators
+                        }
                     }
-                }
+                ]
             }
         },
         "sort": [
@@ -39,19 +52,25 @@ def seachTopic(topics,excluded_videos):
         "size": len(topics),
         "_source": ["statistics.viewCount",'most_relevant_topic']  # Request to return only the viewCount field
     }
-   
+    return query
 
+
+def seachTopic(topics,excluded_videos):
     # Execute the search request
-    return es.search(index="videos_test", body=query)
+    return es.search(index="videos_test", body=build_topic_query(topics, excluded_videos))
 
-def update_recommended_topics_to_user(user_id, new_topics):
+def update_recommended_topics_to_user(user_id, new_topics, user_context=None):
     """
     Update the list of recommended topics for a user in the 'users' index.
     Replace it with new_topics.
 
     :param user_id: The unique identifier for the user.
     :param new_topics: A list of new topics to add.
+    :param user_context: Optional UserContext of the user, updated and committed instead of a separate update request.
     """
+    if user_context is not None:
+        user_context.set(recommended_topics_in_top_popular_rs=new_topics)
+        return user_context.commit()
     
     # Define the script for the update query
     script = {
@@ -63,10 +82,7 @@ def update_recommended_topics_to_user(user_id, new_topics):
     }
 
     # Execute the update query
-    response = es.update(index="users", id=user_id, body={"script": script})
-    resp = es.indices.refresh(
-            index="users",
-    )
+    response = es.update(index="users", id=user_id, body={"script": script}, refresh=database_queries.write_refresh())
     if response['result'] == 'updated':
         # print(f"Top-popular RS: updated user {user_id} with the new topics recommended by the top-popular RS.")
         pass
@@ -76,39 +92,38 @@ def update_recommended_topics_to_user(user_id, new_topics):
     return response['result']
     
 
-def get_recommendations(user_id):
-    # Get n_recs_per_model
-    n_recs_per_model = {}
-    response = es.get(index="users", id=user_id)
-
-    # Check if the document was found
-    if response['found']:
-        # Extract the 'n_recs_per_model' field from the document
-        n_recs_per_model = response['_source'].get('n_recs_per_model', {})
-
+def get_videos_rated_by_user(user_id):
+    """
+    Returns the IDs of the videos the user gave feedback on.
+    """
     # Get all the entries of the user in the ES index 'feedback'
     feedback_entries = database_queries.get_all_feedback_by_user_id(user_id)
 
     # Extract the ID of the videos
-    watched_videos_ids = [feedback['videoId'] for feedback in feedback_entries]
+    return [feedback['videoId'] for feedback in feedback_entries]
 
-    disliked_channels_video_ids = database_queries.read_disliked_video_ids(user_id=user_id)
-    excluded_videos = list(set(watched_videos_ids).union(set(disliked_channels_video_ids)))
+
+def plan_recommendations(user_id, user_context):
+    """
+    Samples the topics for the top-popular, exploitative and explorative recommenders without querying
+    Elasticsearch. The newly recommended top-popular topics are set on the user_context, the caller commits them.
+
+    :return: A dict with the sampled topics of each recommender and the user's exploit_coeff.
+             If 'skip' is True, no recommendations are made.
+    """
+    # Get n_recs_per_model
+    n_recs_per_model = user_context.get('n_recs_per_model', {})
 
     recommended_topics = None
-    # Define the query to search for the user by user_id
     try:
-        # Fetch the document for the specified user_id
-        response = es.get(index="users", id=user_id)
-        
-        # Extract 'exploit_coeff' from the document
-        recommended_topics = response['_source'].get('recommended_topics_in_top_popular_rs')
+        # Extract 'recommended_topics_in_top_popular_rs' from the document
+        recommended_topics = user_context.get('recommended_topics_in_top_popular_rs')
     except Exception as e:
         print(f"An error occurred while fetching 'recommended_topics_in_top_popular_rs' for user {user_id}: {e}")
 
     if len(recommended_topics) >= (num_topics_in_database - len(config.settings.filtered_topics)):
         print(f"All topics have been recommended to user {user_id} once by the top-popular RS. Resetting the topics loop.")
-        update_recommended_topics_to_user(user_id=user_id,new_topics=[])
+        user_context.set(recommended_topics_in_top_popular_rs=[])
         recommended_topics = []
 
     # Sample new topics
@@ -126,29 +141,14 @@ def get_recommendations(user_id):
     # Ensure we don't try to sample more topics than available
     n_recs = min(n_recs_per_model['unpersonalised'], len(available_topics))
     
-    # Sample `k` topics at  from the available topics, converting the set to a list
-    new_topics = .sample(list(available_topics), n_recs)
+    # Sample `k` topics at random from the available topics, converting the set to a list
+    new_topics = random.sample(list(available_topics), n_recs)
     print(f'Topics recommended by top-popular RS: ')
-    # Get recommendations
-    recommendations = []
     print(len(new_topics))
 
-    # Execute the search request
-    response = seachTopic(new_topics,excluded_videos)
-    # Check if any documents were found
-        # Extract the video ID
-    for video in response['hits']['hits']:
-        video_id = video['_id']
-    # Extract the viewCount
-        view_count = video['_source']['statistics']['viewCount']
-        #Generate explanation for the recommendation
-        formatted_view_count = helper_functions.format_number(num=view_count)
-        explanation = f'Recommended to you because it was popular among other users ({formatted_view_count} views).'
-        recommendations.append({"videoId": video_id, "explanation": explanation, "model": "top-popular"})
-        # Return both video ID and viewCount
     # Update the user's profile with new recommended topics (if any new recommendations were made)
     if new_topics:
-        response = update_recommended_topics_to_user(user_id=user_id,new_topics=new_topics)
+        user_context.set(recommended_topics_in_top_popular_rs=new_topics)
     
     exploit_coeff = None
     topic_categories=None
@@ -156,15 +156,12 @@ def get_recommendations(user_id):
     n_recs_exploit=None
     n_recs_explore=None
     try:
-        # Get the document for the specified user_id
-        response = es.get(index="users", id=user_id)
-        if response.get('found', False):
-            # 1. Get exploit_coeff
-            exploit_coeff = response['_source'].get('exploit_coeff')
-            # 3. Read topic_categories
-            topic_categories = response['_source'].get('topic_categories', None)
-            # 4. Read processed_topic_scores
-            processed_topic_scores=response['_source'].get('processed_topic_scores', None)
+        # 1. Get exploit_coeff
+        exploit_coeff = user_context.get('exploit_coeff')
+        # 3. Read topic_categories
+        topic_categories = user_context.get('topic_categories', None)
+        # 4. Read processed_topic_scores
+        processed_topic_scores=user_context.get('processed_topic_scores', None)
         # 2. Get number of exploitative and explorative recommencations
     except Exception as e:
         print(f"An error occurred while fetching topic categories for user {user_id}: {e}")
@@ -178,7 +175,7 @@ def get_recommendations(user_id):
                                                    topic_categories=topic_categories)
     
     if n_recs_exploit == 0:
-        return[]
+        return {"skip": True}
     
     # Get the "most_liked" topics
     most_liked_topics = topic_categories.get('most_liked', [])
@@ -198,19 +195,91 @@ def get_recommendations(user_id):
     )
 
     exploitative_topics = sampled_topic_indices.tolist()
-   
-    response = seachTopic(exploitative_topics,  excluded_videos)
+
+    return {
+        "skip": False,
+        "exploit_coeff": exploit_coeff,
+        "top_popular_topics": new_topics,
+        "exploitative_topics": exploitative_topics,
+        "explorative_topics": explorative_topics
+    }
+
+
+def build_candidate_searches(plan, excluded_videos, excluded_channels=()):
+    """
+    Builds the _msearch body with one candidate query per recommender of the plan,
+    in the order top-popular, exploitative, explorative.
+    """
+    searches = []
+    for topics in (plan['top_popular_topics'], plan['exploitative_topics'], plan['explorative_topics']):
+        searches.append({"index": "videos_test"})
+        searches.append(build_topic_query(topics, excluded_videos, excluded_channels))
+    return searches
+
+
+def search_candidates_in_memory(plan, exclusions):
+    """
+    Answers the searches of build_candidate_searches from the in-memory topic video index,
+    skipping the videos of the user's exclusions (see exclusion_filter).
+
+    :return: The list of responses, or None if the index is disabled or not available.
+    """
+    if not config.settings.TOPIC_VIDEO_INDEX_ENABLED:
+        return None
+    index = topic_video_index.get_index()
+    if index is None:
+        return None
+    excluded_ordinals = exclusions.bitmap(index)
+    return [index.search_response(topics, excluded_ordinals)
+            for topics in (plan['top_popular_topics'], plan['exploitative_topics'], plan['explorative_topics'])]
+
+
+def search_candidates(plan, exclusions):
+    """
+    Returns the responses to the searches of build_candidate_searches, from the in-memory topic video index
+    if available and from a single _msearch otherwise. Failed searches are returned without hits.
+    """
+    responses = search_candidates_in_memory(plan, exclusions)
+    if responses is None:
+        responses = es.msearch(searches=build_candidate_searches(plan, list(exclusions.video_ids),
+                                                                list(exclusions.channel_ids)))['responses']
+        # A failed search does not fail the others: log it and recommend nothing from that recommender
+        for i, (recommender, response) in enumerate(zip(('top-popular', 'exploitative', 'explorative'), responses)):
+            if 'error' in response:
+                print(f"Error in the {recommender} candidate search: {response['error']}")
+                responses[i] = {"hits": {"hits": []}}
+    return responses
+
+
+def assemble_recommendations(plan, responses):
+    """
+    Turns the responses to the searches of build_candidate_searches into the shuffled list of
+    recommendations with their explanations.
+    """
+    top_popular_response, exploitative_response, explorative_response = responses
+    exploit_coeff = plan['exploit_coeff']
+    recommendations = []
+
+    # Check if any documents were found
+        # Extract the video ID
+    for video in top_popular_response['hits']['hits']:
+        video_id = video['_id']
+    # Extract the viewCount
+        view_count = video['_source']['statistics']['viewCount']
+        #Generate explanation for the recommendation
+        formatted_view_count = helper_functions.format_number(num=view_count)
+        explanation = f'Recommended to you because it was popular among other users ({formatted_view_count} views).'
+        recommendations.append({"videoId": video_id, "explanation": explanation, "model": "top-popular"})
+        # Return both video ID and viewCount
   
-    for video in response['hits']['hits']:
+    for video in exploitative_response['hits']['hits']:
         video_id = video['_id']
         explanation = new_personalised_rs.generate_explanation(topic=video['_source']['most_relevant_topic'], exploit_rec=True, exploit_coeff=exploit_coeff)
         # Append recommendation to the list
         recommendations.append({"videoId": video_id, "explanation": explanation, "model": "new personalised exploitation/exploration"})
         # Return both video ID and viewCount
-   
-    response = seachTopic(explorative_topics,  excluded_videos)
   
-    for video in response['hits']['hits']:
+    for video in explorative_response['hits']['hits']:
         video_id = video['_id']
         explanation = new_personalised_rs.generate_explanation(topic=video['_source']['most_relevant_topic'], exploit_rec=False, exploit_coeff=exploit_coeff)
         # Append recommendation to the list
@@ -223,6 +292,23 @@ def get_recommendations(user_id):
     return recommendations
 
 
+def get_recommendations(user_id, user_context=None):
+    # Read the user document once for the whole request
+    if user_context is None:
+        user_context = UserContext.load(user_id)
+
+    # Videos the user gave feedback on and videos of disliked creators, cached across requests
+    exclusions = exclusion_filter.get_exclusions(user_id, user_context)
+
+    # Sample the topics of all recommenders before querying Elasticsearch
+    plan = plan_recommendations(user_id, user_context)
+    user_context.commit()
+    if plan['skip']:
+        return []
+
+    return assemble_recommendations(plan, search_candidates(plan, exclusions))
+
+
 def register_user_parameters(user_id, liked_topic_ids):
     """
     Calculates user-specific values and updates the Elasticsearch index.
@@ -288,7 +374,6 @@ def register_user_parameters(user_id, liked_topic_ids):
             'disliked': [],
             'unrated': unrated_topic_ids
         },
-        "disliked_creators_video_ids": [],
         "disliked_creators":[]
     }
     
@@ -296,10 +381,8 @@ def register_user_parameters(user_id, liked_topic_ids):
     try:
         # Example Elasticsearch update operation
        
-        response = es.update(index="users", id=user_id, body={"doc": user_data}, doc_as_upsert=True)
-        resp = es.indices.refresh(
-        index="users",
-        )
+        response = es.update(index="users", id=user_id, body={"doc": user_data}, doc_as_upsert=True,
+                             refresh=database_queries.write_refresh())
         if response['result'] in ['updated', 'created']:
             return f'User {user_id} registered and preferences updated successfully.'
         else:
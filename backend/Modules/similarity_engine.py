@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+import config.settings
+from Modules.ann_index import AnnIndex
+from config.settings import TOPIC_MODELING_RUNS_DIR
+
+# Files written to the run directory by build_similarity_matrix
+MATRIX_FILE = 'similarity_matrix.npy'
+NORMS_FILE = 'similarity_norms.npy'
+VIDEO_IDS_FILE = 'similarity_video_ids.json'
+
+
+def build_similarity_matrix(run_dir):
+    """
+    Converts the topic distributions of a run (topic_distributions.json) into the files of the similarity engine:
+    a video-by-topic float32 matrix with L2-normalised rows, the original norm of every row and the video IDs.
+    The matrix is written row by row, so the distributions never have to fit in memory at once.
+
+    :param run_dir: The directory of the topic modeling run.
+    """
+    topic_distributions_path = os.path.join(run_dir, 'topic_distributions.json')
+
+    # First pass: number of videos and topics
+    num_videos = 0
+    num_topics = None
+    with open(topic_distributions_path, 'r') as file:
+        for line in file:
+            if num_topics is None:
+                num_topics = len(json.loads(line)['topic_distribution'])
+            num_videos += 1
+
+    matrix = np.lib.format.open_memmap(os.path.join(run_dir, MATRIX_FILE), mode='w+', dtype=np.float32,
+                                       shape=(num_videos, num_topics or 0))
+    norms = np.zeros(num_videos, dtype=np.float32)
+    video_ids = []
+
+    # Second pass: normalised rows
+    with open(topic_distributions_path, 'r') as file:
+        for row, line in enumerate(file):
+            video = json.loads(line)
+            distribution = np.asarray(video['topic_distribution'], dtype=np.float32)
+            norm = np.linalg.norm(distribution)
+            norms[row] = norm
+            matrix[row] = distribution / norm if norm > 0 else distribution
+            video_ids.append(video['id'])
+
+    matrix.flush()
+    del matrix
+    np.save(os.path.join(run_dir, NORMS_FILE), norms)
+    with open(os.path.join(run_dir, VIDEO_IDS_FILE), 'w') as file:
+        json.dump(video_ids, file)
+    print(f"Similarity engine: wrote the matrix of {num_videos} videos and {num_topics} topics to {run_dir}.")
+
+
+class SimilarityEngine:
+    """
+    Cosine similarity search of a user's topic preferences against the topic distributions of all videos.
+    Same ranking as database_queries.similarity_search, computed with one matrix-vector product.
+    If the run has an ANN index (see ann_index.build_ann_index), only the videos of the nprobe closest
+    inverted lists are scored.
+    """
+
+    def __init__(self, video_ids, matrix, norms, ann=None):
+        self.video_ids = video_ids
+        self.ordinal_of = {video_id: ordinal for ordinal, video_id in enumerate(video_ids)}
+        self.matrix = matrix
+        self.norms = norms
+        self.ann = ann
+
+    @classmethod
+    def load(cls, run_dir):
+        """
+        Memory-maps the files written by build_similarity_matrix.
+
+        :return: A SimilarityEngine, or None if the run directory has no similarity matrix.
+        """
+        matrix_path = os.path.join(run_dir, MATRIX_FILE)
+        if not os.path.exists(matrix_path):
+            return None
+        matrix = np.load(matrix_path, mmap_mode='r')
+        norms = np.load(os.path.join(run_dir, NORMS_FILE))
+        with open(os.path.join(run_dir, VIDEO_IDS_FILE), 'r') as file:
+            video_ids = json.load(file)
+        return cls(video_ids, matrix, norms, AnnIndex.load(run_dir))
+
+    def most_relevant_topics(self, ordinal, n=3):
+        """
+        Returns the n highest scored topics of a video in the format of the 'most_relevant_topics' field.
+        """
+        distribution = self.matrix[ordinal] * self.norms[ordinal]
+        top_topics = np.argsort(-distribution, kind='stable')[:n]
+        return [{'topic_index': int(topic), 'score': float(distribution[topic])} for topic in top_topics]
+
+    def search(self, topic_preferences, excluded_videos, k, nprobe=None):
+        """
+        Returns the k videos most similar to the topic preferences, skipping the excluded videos.
+
+        :param topic_preferences: List of topic preferences for the user.
+        :param excluded_videos: Iterable of video IDs to skip.
+        :param k: Number of videos to return.
+        :param nprobe: Number of inverted lists of the ANN index to search, 0 for an exact search.
+                       Defaults to SIMILARITY_ANN_NPROBE.
+        :return: List of dicts with 'video_id' and 'most_relevant_topics', most similar first.
+        """
+        return [{
+            "video_id": self.video_ids[ordinal],
+            "most_relevant_topics": self.most_relevant_topics(ordinal)
+        } for ordinal in self.search_ordinals(topic_preferences, excluded_videos, k, nprobe=nprobe)]
+
+    def search_ordinals(self, topic_preferences, excluded_videos, k, nprobe=None):
+        """
+        Same as search(), but returns the ordinals of the videos.
+        """
+        if nprobe is None:
+            nprobe = config.settings.SIMILARITY_ANN_NPROBE
+        query = np.asarray(topic_preferences, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm > 0:
+            query = query / query_norm
+        excluded = {self.ordinal_of[video_id] for video_id in excluded_videos if video_id in self.ordinal_of}
+
+        if self.ann is None or nprobe <= 0:
+            candidates = None
+        else:
+            # Probe more lists until they hold enough videos that are not excluded
+            while True:
+                candidates = np.sort(self.ann.candidates(query, nprobe))
+                if len(candidates) - len(excluded) >= k or nprobe >= len(self.ann.centroids):
+                    break
+                nprobe *= 2
+
+        if candidates is None:
+            candidates = np.arange(len(self.video_ids))
+            scores = self.matrix @ query + np.float32(1.0)
+        else:
+            scores = self.matrix[candidates] @ query + np.float32(1.0)
+        # Videos without any topic have no cosine similarity, Elasticsearch scores them 0
+        scores[self.norms[candidates] == 0] = 0.0
+        if excluded:
+            scores[np.isin(candidates, list(excluded))] = -np.inf
+
+        k = min(k, int(np.count_nonzero(scores != -np.inf)))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((candidates[top], -scores[top]))]
+        return candidates[top].tolist()
+
+
+# Engine of the topic modeling run in the database, see get_engine
+_engine = None
+_engine_run_id = None
+# Run without a similarity matrix and when it was last looked for
+_missing_run_id = None
+_missing_at = 0.0
+_lock = threading.Lock()
+
+# Number of seconds before looking again for the similarity matrix of a run that had none
+MISSING_ENGINE_RETRY_SECONDS = 60
+
+
+def get_engine(run_id=None):
+    """
+    Returns the similarity engine of the given run (default: tm_run_in_database), loading it on first use.
+    If the run has no similarity matrix (yet), it is looked for again after MISSING_ENGINE_RETRY_SECONDS.
+
+    :return: A SimilarityEngine, or None if the run has no similarity matrix.
+    """
+    global _engine, _engine_run_id, _missing_run_id, _missing_at
+    if run_id is None:
+        run_id = config.settings.tm_run_in_database
+    with _lock:
+        if _engine_run_id == run_id:
+            return _engine
+        if run_id == _missing_run_id and time.time() - _missing_at < MISSING_ENGINE_RETRY_SECONDS:
+            return None
+        engine = SimilarityEngine.load(os.path.join(TOPIC_MODELING_RUNS_DIR, run_id))
+        if engine is None:
+            print(f"Similarity engine: no similarity matrix in run '{run_id}'.")
+            _missing_run_id = run_id
+            _missing_at = time.time()
+            return None
+        _engine = engine
+        _engine_run_id = run_id
+        return _engine
@@ -0,0 +1,71 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+
+def text_hash(text):
+    """
+    Returns the content hash under which a value derived from a text is cached.
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class SqliteCache:
+    """
+    Persistent key-value cache in one SQLite table, keyed by content hashes (see text_hash).
+    Counts the hits and misses of the lookups since it was opened.
+    """
+
+    # Maximum number of parameters of one SQLite query
+    _MAX_VARIABLES = 900
+
+    def __init__(self, path, table, value_column='value'):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.table = table
+        self.value_column = value_column
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (hash TEXT PRIMARY KEY, {value_column} TEXT NOT NULL)")
+        self._connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, hashes):
+        """
+        Looks up the values of the given hashes.
+
+        :return: Dict from hash to value for the hashes that are cached.
+        """
+        hashes = list(hashes)
+        values = {}
+        with self._lock:
+            for start in range(0, len(hashes), self._MAX_VARIABLES):
+                batch = hashes[start:start + self._MAX_VARIABLES]
+                rows = self._connection.execute(
+                    f"SELECT hash, {self.value_column} FROM {self.table} "
+                    f"WHERE hash IN ({','.join('?' * len(batch))})", batch)
+                values.update(rows)
+            found = sum(1 for hash_ in hashes if hash_ in values)
+            self.hits += found
+            self.misses += len(hashes) - found
+        return values
+
+    def put_many(self, values):
+        """
+        Stores the values of a dict from hash to value.
+        """
+        with self._lock:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (hash, {self.value_column}) VALUES (?, ?)", values.items())
+            self._connection.commit()
+
+    def stats(self):
+        """
+        Returns the number of lookups, hits and misses since the cache was opened and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {'lookups': lookups, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
@@ -1,7 +1,9 @@
+import atexit
 import re
+from collections import deque
+from functools import lru_cache
 from urllib.parse import unquote
 import spacy
-import numpy as np
 from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import pandas as pd
@@ -21,8 +23,22 @@ stop_words_dict = {
     'it': it_stop
 }
 
-# Load nlp model once for efficiency
-nlp = spacy.load('en_core_web_sm')
+# spaCy model used for tokenization and lemmatization
+MODEL_NAME = 'en_core_web_sm'
+
+# Loaded once per process on first use, see get_nlp
+nlp = None
+
+
+def get_nlp():
+    """
+    Returns the spaCy pipeline, loading it on first use. Only the components needed for the lemmas are loaded,
+    the parser and the named entity recognizer are never used.
+    """
+    global nlp
+    if nlp is None:
+        nlp = spacy.load(MODEL_NAME, exclude=['parser', 'ner'])
+    return nlp
 
 
 # Function to load stop words for specified languages
@@ -35,6 +51,25 @@ def load_stop_words(languages):
     return stop_words
 
 
+@lru_cache(maxsize=None)
+def get_stop_words(languages):
+    """
+    Cached union of the stop words of a frozenset of languages.
+    """
+    return frozenset(load_stop_words(languages))
+
+
+def pipeline_id():
+    """
+    Identifies the spaCy pipeline, so that cached processed texts are not reused across models.
+    """
+    return f"{MODEL_NAME}-{spacy.util.get_package_version(MODEL_NAME)}"
+
+
+def _language_set(languages):
+    return frozenset(lang for lang in languages if isinstance(lang, str))
+
+
 # Function to preprocess text
 def preprocess_text(text):
     text = re.sub(r'\s+', ' ', text)  # Remove newlines and multiple spaces
@@ -44,20 +79,45 @@ def preprocess_text(text):
     return text
 
 
+def _doc_to_text(doc, stop_words):
+    # Remove stop words (from all specified languages) and other criteria
+    tokens = [token.lemma_ for token in doc if token.text not in stop_words and not token.is_punct and not token.like_num and len(token.text) > 1]
+    return " ".join(tokens)
+
+
 # Main text processing function (now accepting languages)
 def process_text(text, languages):
-    languages = [lang for lang in languages if isinstance(lang, str)]
-    stop_words = load_stop_words(languages)
+    stop_words = get_stop_words(_language_set(languages))
     
     # Preprocess the text
     text = preprocess_text(text)
     
     # Tokenize with Spacy (we'll use the English model for tokenization purposes)
-    doc = nlp(text)
+    doc = get_nlp()(text)
     
-    # Remove stop words (from all specified languages) and other criteria
-    tokens = [token.lemma_ for token in doc if token.text not in stop_words and not token.is_punct and not token.like_num and len(token.text) > 1]
-    return " ".join(tokens)
+    return _doc_to_text(doc, stop_words)
+
+
+def process_texts(texts, languages_list, batch_size=256):
+    """
+    Batched version of process_text: the texts are grouped by their set of languages and every group is
+    tokenized with nlp.pipe, filtering with the cached stop words of the group.
+
+    :param texts: List of texts.
+    :param languages_list: List with the languages of every text.
+    :return: List of processed texts, in the order of the input.
+    """
+    groups = {}
+    for position, languages in enumerate(languages_list):
+        groups.setdefault(_language_set(languages), []).append(position)
+
+    processed = [None] * len(texts)
+    for languages, positions in groups.items():
+        stop_words = get_stop_words(languages)
+        docs = get_nlp().pipe((preprocess_text(texts[position]) for position in positions), batch_size=batch_size)
+        for position, doc in zip(positions, docs):
+            processed[position] = _doc_to_text(doc, stop_words)
+    return processed
 
 
 def process_wikipedia_tags(tags):
@@ -78,21 +138,88 @@ def process_wikipedia_tags(tags):
     return ' '.join(processed_tags)
 
 
-def parallelize_dataframe_processing(df, func, n_cores):
-    # Split DataFrame into chunks
-    df_split = np.array_split(df, n_cores)
-    # Create a pool of processes
-    pool = ProcessPoolExecutor(n_cores)
-    
-    # Process the DataFrame chunks in parallel
-    df_processed_list = list(tqdm(pool.map(func, df_split), total=n_cores))
+# Worker processes shared by all parallel processing, see get_worker_pool
+_pool = None
+_pool_size = None
+
+
+def _init_worker():
+    # Load spaCy once per worker, before the first chunk arrives
+    get_nlp()
+
+
+def get_worker_pool(n_cores):
+    """
+    Returns the process pool with n_cores workers, creating it on first use. The pool is reused across calls
+    and shut down when the interpreter exits.
+    """
+    global _pool, _pool_size
+    if _pool is None or _pool_size != n_cores:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = ProcessPoolExecutor(n_cores, initializer=_init_worker)
+        _pool_size = n_cores
+    return _pool
+
+
+@atexit.register
+def shutdown_worker_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+def _map_chunks(func, chunks, n_cores, total):
+    """
+    Runs func on every chunk in the worker pool and yields the results in order. At most 2 * n_cores chunks are
+    in flight, so memory stays bounded, and a free worker always picks up the next chunk.
+    """
+    pool = get_worker_pool(n_cores)
+    in_flight = deque()
+    with tqdm(total=total) as progress:
+        for chunk in chunks:
+            in_flight.append(pool.submit(func, chunk))
+            if len(in_flight) >= 2 * n_cores:
+                yield in_flight.popleft().result()
+                progress.update()
+        while in_flight:
+            yield in_flight.popleft().result()
+            progress.update()
+
+
+def parallelize_dataframe_processing(df, func, n_cores, chunk_size=500):
+    # Process the DataFrame in small chunks of rows in parallel
+    chunks = (df.iloc[start:start + chunk_size] for start in range(0, len(df), chunk_size))
+    df_processed_list = list(_map_chunks(func, chunks, n_cores, total=-(-len(df) // chunk_size)))
     # Combine chunks back into a single DataFrame
+    if not df_processed_list:
+        return df.reset_index(drop=True)
     df_processed = pd.concat(df_processed_list, ignore_index=True)
 
     return df_processed
 
 
+def _process_text_chunk(chunk):
+    texts, languages_list = chunk
+    return process_texts(texts, languages_list)
+
+
+def process_texts_parallel(texts, languages_list, n_cores, chunk_size=500):
+    """
+    process_texts in the worker pool. Only the texts and languages are sent to the workers.
+
+    :return: List of processed texts, in the order of the input.
+    """
+    chunks = ((texts[start:start + chunk_size], languages_list[start:start + chunk_size])
+              for start in range(0, len(texts), chunk_size))
+    processed = []
+    for processed_chunk in _map_chunks(_process_text_chunk, chunks, n_cores, total=-(-len(texts) // chunk_size)):
+        processed.extend(processed_chunk)
+    return processed
+
+
 def process_chunk(chunk):
     # Process each chunk with the languages
-    chunk['processed_text'] = chunk.apply(lambda row: process_text(row['combined_text'], row['languages']), axis=1)
+    chunk['processed_text'] = process_texts(chunk['combined_text'].tolist(), chunk['languages'].tolist())
     return chunk
@@ -0,0 +1,39 @@
+import threading
+
+from Modules.sqlite_cache import SqliteCache, text_hash
+from config.settings import TOKEN_CACHE_PATH
+
+
+def token_key(combined_text, languages, pipeline_id):
+    """
+    Returns the key of the processed text of a video: the content hash of its combined text, its set of
+    languages (which select the stop words) and the spaCy pipeline that processed it.
+    """
+    language_set = ','.join(sorted(lang for lang in languages if isinstance(lang, str)))
+    return text_hash(f"{pipeline_id}\x00{language_set}\x00{combined_text}")
+
+
+class TokenCache(SqliteCache):
+    """
+    Persistent SQLite cache of the processed texts of text_processing (lemmatized tokens joined by spaces),
+    keyed by token_key. Only new or edited videos have to be run through spaCy again.
+    """
+
+    def __init__(self, path):
+        super().__init__(path, 'processed_texts')
+
+
+# Process-wide cache, see get_cache
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the token cache at TOKEN_CACHE_PATH, opening it on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TokenCache(TOKEN_CACHE_PATH)
+        return _cache
@@ -1,9 +1,10 @@
 import sys
 sys.path.append('/Users/pablojerezarnau/git/RS-backend/')
 
-from Modules import rs_logic
+from Modules import rs_logic, similarity_engine
 from Modules.topic_preferences_management import read_topic_preferences_of_user, database_queries
 from collections import Counter
+import config.settings
 
 
 def generate_individual_explanation(most_relevant_topics, topic_descriptions):
@@ -94,8 +95,12 @@ def get_recommendations(user_id, n_recs):
     # Identify videos already watched by the user to exclude from recommendations
     watched_videos = rs_logic.get_videos_rated_by_user(user_id=user_id)
 
-    # Conduct a similarity search
-    similarity_results = database_queries.similarity_search(topic_preferences=topic_preferences, watched_videos=watched_videos, k=n_recs)
+    # Conduct a similarity search, locally if the run in the database has a similarity matrix
+    engine = similarity_engine.get_engine() if config.settings.SIMILARITY_ENGINE == 'local' else None
+    if engine is not None:
+        similarity_results = engine.search(topic_preferences=topic_preferences, excluded_videos=watched_videos, k=n_recs)
+    else:
+        similarity_results = database_queries.similarity_search(topic_preferences=topic_preferences, watched_videos=watched_videos, k=n_recs)
     
     recommendations = []
     # Create personalized explanations for each recommended video.
@@ -0,0 +1,121 @@
+import threading
+import time
+
+from elasticsearch.helpers import scan
+
+from Modules.database_queries import es
+from config.settings import TOPIC_CATALOG_TTL_SECONDS
+
+# Process-wide copy of the 'topics' index, keyed by topic number
+_catalog = None
+_loaded_at = 0.0
+_lock = threading.Lock()
+# Whether a background refresh is running, and the number of invalidations (a refresh that started before an
+# invalidation must not store its result)
+_refreshing = False
+_generation = 0
+
+
+def _load_catalog(index_name='topics'):
+    """
+    Reads every document of the topics index and keys it by its topic number.
+
+    :param index_name: Name of the Elasticsearch index containing topics data.
+    :return: A dictionary mapping each topic number (int) to the topic document.
+    """
+    catalog = {}
+    for hit in scan(client=es, index=index_name, query={"query": {"match_all": {}}}):
+        topic = hit['_source']
+        topic_number = topic.get('topic_number', hit['_id'])
+        try:
+            catalog[int(topic_number)] = topic
+        except (TypeError, ValueError):
+            print(f"Topic catalog: skipping topic document with invalid topic number '{topic_number}'.")
+    print(f"Topic catalog: loaded {len(catalog)} topics from index '{index_name}'.")
+    return catalog
+
+
+def _refresh(generation):
+    global _catalog, _loaded_at, _refreshing
+    try:
+        catalog = _load_catalog()
+    except Exception as e:
+        # Keep serving the previous catalog and retry after the TTL
+        print(f"An error occurred while refreshing the topic catalog: {e}")
+        catalog = None
+    with _lock:
+        if generation == _generation:
+            if catalog is not None:
+                _catalog = catalog
+            _loaded_at = time.time()
+            _refreshing = False
+
+
+def get_catalog():
+    """
+    Returns the cached topic catalog. It is loaded from Elasticsearch on the first lookup and after an
+    invalidation. Once it is older than TOPIC_CATALOG_TTL_SECONDS, a single background thread reloads it
+    while the lookups keep getting the previous catalog.
+
+    :return: A dictionary mapping each topic number (int) to the topic document.
+    """
+    global _catalog, _loaded_at, _refreshing
+    catalog = _catalog
+    if catalog is not None:
+        if time.time() - _loaded_at >= TOPIC_CATALOG_TTL_SECONDS:
+            with _lock:
+                if not _refreshing and time.time() - _loaded_at >= TOPIC_CATALOG_TTL_SECONDS:
+                    _refreshing = True
+                    threading.Thread(target=_refresh, args=(_generation,), name='topic-catalog-refresh',
+                                     daemon=True).start()
+        return catalog
+
+    with _lock:
+        # Another thread may have loaded the catalog while we were waiting
+        if _catalog is None:
+            _catalog = _load_catalog()
+            _loaded_at = time.time()
+        return _catalog
+
+
+def invalidate():
+    """
+    Drops the cached topic catalog so that the next lookup reloads it from Elasticsearch.
+    Call this after the 'topics' index has been rewritten.
+    """
+    global _catalog, _loaded_at, _generation, _refreshing
+    with _lock:
+        _catalog = None
+        _loaded_at = 0.0
+        _generation += 1
+        _refreshing = False
+
+
+def get_topic(topic_id):
+    """
+    Returns the topic document for the given topic id, or None if the topic is unknown.
+
+    :param topic_id: The topic number, either as int or as string (e.g. a key of processed_topic_scores).
+    """
+    try:
+        return get_catalog().get(int(topic_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_description(topic_id):
+    """
+    Returns the description of the given topic, or None if the topic is unknown.
+    """
+    topic = get_topic(topic_id)
+    if topic is None:
+        return None
+    return topic.get('description')
+
+
+def get_descriptions():
+    """
+    Returns a dictionary mapping each topic number to its description, skipping topics without description.
+    """
+    return {topic_number: topic['description'] for topic_number, topic in get_catalog().items()
+            if topic.get('description') is not None}
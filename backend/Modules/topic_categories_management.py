@@ -90,7 +90,7 @@ def get_rated_topics(user_id):
     return list(rated_topics)
 
 
-def calculate_topic_categories(user_id):
+def calculate_topic_categories(user_id, user_context=None):
     """
     Retrieves and organizes the user's topic preferences into categories.
 
@@ -100,6 +100,7 @@ def calculate_topic_categories(user_id):
 
     Parameters:
     - user_id (str): The unique identifier of the user for whom topic categories are retrieved.
+    - user_context (UserContext): Optional, already loaded user document to read the topic preferences from.
 
     Returns:
     - dict: A dictionary containing lists of topic indices for each category:
@@ -108,7 +109,7 @@ def calculate_topic_categories(user_id):
         - 'unrated': Topics that have not been rated or interacted with.
     """
     # Calculate most liked topics based on user feedback
-    topic_preferences = topic_preferences_management.read_topic_preferences_of_user(user_id=user_id)
+    topic_preferences = topic_preferences_management.read_topic_preferences_of_user(user_id=user_id, user_context=user_context)
   
     # take the first 10, then extract only the indices.
     most_liked_topics = [index for index, score in sorted(enumerate(topic_preferences), key=lambda x: x[1], reverse=True)[:10]]
@@ -0,0 +1,218 @@
+import time
+
+import gensim
+import numpy as np
+from sklearn.decomposition import NMF
+
+import config.settings
+
+# Topic scores at or below this value are set to 0, like gensim's get_document_topics does
+MINIMUM_PROBABILITY = 1e-8
+
+
+def _normalize_rows(scores):
+    """
+    Normalizes every row of a document-topic matrix to sum to 1 (rows of zeros stay zero) and clears the scores at
+    or below MINIMUM_PROBABILITY.
+    """
+    sums = scores.sum(axis=1, keepdims=True)
+    scores = np.divide(scores, sums, out=np.zeros_like(scores), where=sums > 0)
+    scores[scores <= MINIMUM_PROBABILITY] = 0
+    return scores
+
+
+def _nonnegative_projection(term_document, W, max_iter=100, tol=0.0001):
+    """
+    Solves min ||v - W h|| subject to h >= 0 for every document column v of the term-document matrix, with
+    coordinate descent over the topics applied to all documents at once. Every document stops on its own, once an
+    iteration changes its h by less than tol relative to its size.
+
+    :param term_document: Sparse matrix of shape (number of terms, number of documents).
+    :param W: Array of shape (number of terms, number of topics).
+    :return: Array of shape (number of documents, number of topics).
+    """
+    WtW = W.T @ W
+    WtV = np.asarray((term_document.T @ W).T)
+    num_topics, num_documents = WtV.shape
+    H = np.zeros((num_topics, num_documents))
+    active = np.arange(num_documents)
+    for _ in range(max_iter):
+        H_active = H[:, active]
+        previous = H_active.copy()
+        for topic in range(num_topics):
+            if WtW[topic, topic] > 0:
+                H_active[topic] = np.maximum(
+                    0, H_active[topic] + (WtV[topic, active] - WtW[topic] @ H_active) / WtW[topic, topic])
+        H[:, active] = H_active
+        change = np.abs(H_active - previous).sum(axis=0)
+        active = active[change > tol * H_active.sum(axis=0)]
+        if not len(active):
+            break
+    return H.T
+
+
+class GensimNmfEngine:
+    """
+    gensim's online NMF, trained single-threaded in chunks of documents. The corpus is passed to gensim as a sparse
+    term-document matrix, so the documents are not converted back into bag-of-words lists.
+
+    The topic distributions are inferred per document with get_document_topics, or, with batched_inference
+    (TOPIC_MODEL_GENSIM_BATCHED_INFERENCE), for a batch of documents at once by _nonnegative_projection on the
+    topics of the model. The batched scores are not identical to get_document_topics, which stops earlier.
+    """
+
+    name = 'gensim'
+
+    def __init__(self, num_topics, id2word, random_state=42, batched_inference=None):
+        self.num_topics = num_topics
+        self.id2word = id2word
+        self.random_state = random_state
+        if batched_inference is None:
+            batched_inference = config.settings.TOPIC_MODEL_GENSIM_BATCHED_INFERENCE
+        self.batched_inference = batched_inference
+        self.model = None
+        # Training and inference time in seconds, see train_and_infer
+        self.timings = {}
+
+    def train(self, corpus):
+        """
+        :param corpus: gensim Sparse2Corpus of the documents (see topic_modeling.create_dictionary_and_corpus).
+        """
+        self.model = gensim.models.nmf.Nmf(corpus=corpus.sparse.tocsc(),
+                                           num_topics=self.num_topics,
+                                           id2word=self.id2word,
+                                           passes=10,
+                                           random_state=self.random_state,
+                                           w_max_iter=400,
+                                           w_stop_condition=0.00001,
+                                           h_max_iter=100,
+                                           h_stop_condition=0.0001)
+        return self
+
+    def document_topics(self, corpus, batch_size=10000):
+        """
+        Infers the topic distributions of the documents, one document at a time or, with batched_inference,
+        batch_size documents at a time.
+
+        :return: Array of shape (number of documents, num_topics), every row sums to 1.
+        """
+        if not self.batched_inference:
+            scores = np.zeros((len(corpus), self.num_topics))
+            for row, bow in enumerate(corpus):
+                for topic_id, score in self.model.get_document_topics(bow, minimum_probability=0):
+                    scores[row, topic_id] = score
+            return scores
+
+        term_document = corpus.sparse.tocsc()
+        W = self.model.get_topics(normalize=False).T
+        scores = np.zeros((term_document.shape[1], self.num_topics))
+        for start in range(0, term_document.shape[1], batch_size):
+            batch = term_document[:, start:start + batch_size]
+            scores[start:start + batch.shape[1]] = _nonnegative_projection(batch, W)
+        return _normalize_rows(scores)
+
+    def show_topic(self, topic_id, topn=10):
+        return self.model.show_topic(topic_id, topn)
+
+
+class SklearnNmfEngine:
+    """
+    scikit-learn's NMF (coordinate descent) trained on the CSR document-term matrix. The matrix products run in the
+    BLAS threads (see threadpoolctl to limit them).
+    """
+
+    name = 'sklearn'
+
+    def __init__(self, num_topics, id2word, random_state=42):
+        self.num_topics = num_topics
+        self.id2word = id2word
+        self.random_state = random_state
+        self.model = None
+        # Training and inference time in seconds, see train_and_infer
+        self.timings = {}
+
+    def train(self, corpus):
+        """
+        :param corpus: gensim Sparse2Corpus of the documents (see topic_modeling.create_dictionary_and_corpus).
+        """
+        self.model = NMF(n_components=self.num_topics,
+                         init='nndsvda',
+                         solver='cd',
+                         max_iter=400,
+                         tol=0.0001,
+                         random_state=self.random_state)
+        self.model.fit(corpus.sparse.T.tocsr().astype(np.float64))
+        return self
+
+    def document_topics(self, corpus, batch_size=10000):
+        """
+        Infers the topic distributions of the documents, batch_size documents at a time.
+
+        :return: Array of shape (number of documents, num_topics), every row sums to 1.
+        """
+        document_term = corpus.sparse.T.tocsr().astype(np.float64)
+        scores = np.zeros((document_term.shape[0], self.num_topics))
+        for start in range(0, document_term.shape[0], batch_size):
+            batch = document_term[start:start + batch_size]
+            scores[start:start + batch.shape[0]] = self.model.transform(batch)
+        return _normalize_rows(scores)
+
+    def show_topic(self, topic_id, topn=10):
+        # Same format as gensim: (word, weight) pairs with the weights of the topic normalised to sum to 1
+        weights = self.model.components_[topic_id]
+        total = weights.sum()
+        top_ids = np.argsort(-weights, kind='stable')[:topn]
+        return [(self.id2word[token_id], float(weights[token_id] / total) if total else 0.0) for token_id in top_ids]
+
+
+ENGINES = {
+    GensimNmfEngine.name: GensimNmfEngine,
+    SklearnNmfEngine.name: SklearnNmfEngine,
+}
+
+
+def get_engine(name, num_topics, id2word):
+    """
+    Creates an untrained topic model engine.
+
+    :param name: Name of the engine, a key of ENGINES.
+    """
+    if name not in ENGINES:
+        raise ValueError(f"Unknown topic model engine '{name}', expected one of {sorted(ENGINES)}")
+    return ENGINES[name](num_topics, id2word)
+
+
+def train_and_infer(name, corpus, id2word, num_topics, batch_size=10000):
+    """
+    Trains an engine on the corpus and infers the topic distributions of its documents.
+
+    :return: Tuple (trained engine, document-topic array). The times are in the engine's timings
+             ('training_seconds' and 'inference_seconds').
+    """
+    engine = get_engine(name, num_topics, id2word)
+    start_time = time.time()
+    engine.train(corpus)
+    training_seconds = time.time() - start_time
+    start_time = time.time()
+    scores = engine.document_topics(corpus, batch_size=batch_size)
+    inference_seconds = time.time() - start_time
+    engine.timings = {'training_seconds': training_seconds, 'inference_seconds': inference_seconds}
+    return engine, scores
+
+
+def benchmark_engines(corpus, id2word, num_topics, trained_engine=None, engines=None, batch_size=10000):
+    """
+    Trains every engine on the same corpus and measures the training and inference times.
+
+    :param trained_engine: An engine already trained on the corpus with train_and_infer, its timings are reused
+                           instead of training it again.
+    :param engines: Names of the engines, by default all of ENGINES.
+    :return: Dict mapping every engine to its 'training_seconds' and 'inference_seconds'.
+    """
+    benchmark = {}
+    for name in (engines or ENGINES):
+        if trained_engine is not None and name == trained_engine.name:
+            benchmark[name] = trained_engine.timings
+        else:
+            benchmark[name] = train_and_infer(name, corpus, id2word, num_topics, batch_size=batch_size)[0].timings
+    return benchmark
@@ -2,12 +2,18 @@ import sys
 sys.path.append('/Users/pablojerezarnau/git/RS-backend/')
 from Modules import database_queries
 from Modules import text_processing
+from Modules import corpus_export
+from Modules import token_cache
+from Modules import topic_model_engines
 import pandas as pd
+import numpy as np
+import scipy.sparse
 import os
-from gensim import corpora
-import gensim
+from gensim.matutils import Sparse2Corpus
 import json
-from config.settings import TOPIC_MODELING_DATA_DIR
+import config.settings
+from config.settings import TOPIC_MODELING_DATA_DIR, TOPIC_MODEL_INFERENCE_BATCH_SIZE
+from config.settings import CORPUS_EXPORT_PARALLEL, CORPUS_EXPORT_DIR, CORPUS_EXPORT_SLICES, CORPUS_EXPORT_LANGUAGE_WORKERS
 from tqdm import tqdm
 tqdm.pandas(desc="Processing texts")
 
@@ -58,21 +64,27 @@ def get_textual_features(data_path, force_overwrite=False):
             # Handle the error or fallback to regenerating the DataFrame
     else:
         print("Local file not found, querying the database...")
-        all_data_instances = database_queries.get_entire_database()
-        textual_features_df = pd.DataFrame.from_records([
-            {
-                'id': video_data.get('id', ''),
-                'title': video_data.get('title', ''),
-                'description': video_data.get('description', ''),
-                'tags': video_data.get('tags', []),
-                'wikipedia_tags': video_data.get('topicCategories', []),
-                'link': video_data.get('link', []),
-                'defaultLanguage': video_data.get('defaultLanguage', []),
-                'defaultAudioLanguage': video_data.get('defaultAudioLanguage', []),
-                'predictedLanguage': video_data.get('predictedLanguage', []),
-                'duration': video_data.get('duration', 1000)
-            } for video_id, video_data in all_data_instances.items()
-        ])
+        if CORPUS_EXPORT_PARALLEL:
+            # Sliced scroll to a Parquet dataset, see corpus_export
+            corpus_export.export_corpus(CORPUS_EXPORT_DIR, num_slices=CORPUS_EXPORT_SLICES,
+                                        language_workers=CORPUS_EXPORT_LANGUAGE_WORKERS)
+            textual_features_df = corpus_export.read_corpus(CORPUS_EXPORT_DIR)
+        else:
+            all_data_instances = database_queries.get_entire_database()
+            textual_features_df = pd.DataFrame.from_records([
+                {
+                    'id': video_data.get('id', ''),
+                    'title': video_data.get('title', ''),
+                    'description': video_data.get('description', ''),
+                    'tags': video_data.get('tags', []),
+                    'wikipedia_tags': video_data.get('topicCategories', []),
+                    'link': video_data.get('link', []),
+                    'defaultLanguage': video_data.get('defaultLanguage', []),
+                    'defaultAudioLanguage': video_data.get('defaultAudioLanguage', []),
+                    'predictedLanguage': video_data.get('predictedLanguage', []),
+                    'duration': video_data.get('duration', 1000)
+                } for video_id, video_data in all_data_instances.items()
+            ])
 
         # Add the column 'languages' to the df
         textual_features_df['languages'] = textual_features_df.apply(get_languages, axis=1)
@@ -119,9 +131,23 @@ def process_and_concatenate_textual_features(df, file_path=os.path.join(TOPIC_MO
                            df['tags'].apply(' '.join) + ' ' +
                            df['processed_wikipedia_tags'].fillna(''))
 
-    # Apply the clean_text function to clean and preprocess the combined text
-    # Example adjustment if parallelize_dataframe_processing returns a DataFrame
-    df = text_processing.parallelize_dataframe_processing(df, text_processing.process_chunk, n_cores=8)
+    # Reuse the processed text of the videos that did not change since an earlier run, see token_cache
+    cache = token_cache.get_cache()
+    pipeline_id = text_processing.pipeline_id()
+    df['cache_key'] = [token_cache.token_key(text, languages, pipeline_id)
+                       for text, languages in zip(df['combined_text'], df['languages'])]
+    processed_texts = cache.get_many(df['cache_key'])
+
+    # Apply the clean_text function to clean and preprocess the combined text of the other videos, once per key
+    missing_df = df.loc[~df['cache_key'].isin(processed_texts.keys()), ['cache_key', 'combined_text', 'languages']]
+    missing_df = missing_df.drop_duplicates('cache_key')
+    if len(missing_df):
+        new_processed_texts = dict(zip(missing_df['cache_key'], text_processing.process_texts_parallel(
+            missing_df['combined_text'].tolist(), missing_df['languages'].tolist(), n_cores=8)))
+        cache.put_many(new_processed_texts)
+        processed_texts.update(new_processed_texts)
+    df['processed_text'] = df['cache_key'].map(processed_texts)
+    df = df.drop(columns='cache_key').reset_index(drop=True)
 
     # Create the directory if it doesn't exist and save the DataFrame as a JSON file
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
@@ -131,6 +157,38 @@ def process_and_concatenate_textual_features(df, file_path=os.path.join(TOPIC_MO
     return df
 
 
+def build_document_term_counts(texts):
+    """
+    Tokenizes the texts (split on whitespace, tokens of one character are dropped) in a single pass and assigns
+    token IDs exactly like gensim's corpora.Dictionary: the new tokens of every document get the next IDs in
+    alphabetical order.
+
+    Parameters:
+    - texts: Iterable of processed texts.
+
+    Returns:
+    - tokens: List of the tokens, the token with ID i at position i.
+    - indptr, indices, counts: CSR arrays (int64, int32, int32) of the document-term counts. The tokens of every
+      document are in the order of their first occurrence in the document.
+    """
+    token2id = {}
+    indptr = [0]
+    indices = []
+    counts = []
+    for text in texts:
+        counter = {}
+        for token in text.split():
+            if len(token) > 1:
+                counter[token] = counter.get(token, 0) + 1
+        for token in sorted(token for token in counter if token not in token2id):
+            token2id[token] = len(token2id)
+        indices.extend(token2id[token] for token in counter)
+        counts.extend(counter.values())
+        indptr.append(len(indices))
+    return (list(token2id), np.asarray(indptr, dtype=np.int64), np.asarray(indices, dtype=np.int32),
+            np.asarray(counts, dtype=np.int32))
+
+
 def create_dictionary_and_corpus(df, min_token_frequency=5, no_above=0.05, keep_n=None, min_tokens_per_document=5):
     """
     Creates a dictionary and corpus from a DataFrame for topic modeling, and calculates the document frequency ratios
@@ -138,6 +196,8 @@ def create_dictionary_and_corpus(df, min_token_frequency=5, no_above=0.05, keep_
 
     This function ensures that tokens are correctly accounted for after filtering extremes from the dictionary,
     providing accurate document frequency ratios for both remaining and filtered-out tokens.
+    The documents are tokenized in one pass into a sparse document-term matrix (see build_document_term_counts),
+    the filtering is done with array operations and gives the same token IDs as gensim's Dictionary.filter_extremes.
 
     Parameters:
     - df: DataFrame with a 'processed_text' column containing preprocessed text documents.
@@ -147,8 +207,9 @@ def create_dictionary_and_corpus(df, min_token_frequency=5, no_above=0.05, keep_
     - min_tokens_per_document: Minimum number of tokens required for a document to be included in the corpus.
 
     Returns:
-    - corpus: List of lists of (int, int) tuples representing the corpus.
+    - corpus: gensim Sparse2Corpus over the CSR document-term matrix of the filtered documents (corpus.sparse).
     - id2word: Dictionary mapping token IDs to tokens.
+    - df: The DataFrame with the columns 'token_count' and 'unique_token_count'.
     - df_filtered: DataFrame filtered based on token count criteria.
     - remaining_tokens_ratio: Dict of remaining tokens and their document frequency ratios.
     - filtered_out_tokens_ratio: Dict of filtered out tokens and their document frequency ratios.
@@ -157,98 +218,98 @@ def create_dictionary_and_corpus(df, min_token_frequency=5, no_above=0.05, keep_
     if 'processed_text' not in df.columns:
         raise ValueError("DataFrame must contain a 'processed_text' column")
 
-    # Tokenize the processed text to prepare for dictionary creation
-    df['tokens'] = df['processed_text'].apply(lambda x: x.split())
-
-    # Filter out tokens that have only one character
-    df['tokens'] = df['tokens'].apply(lambda tokens: [token for token in tokens if len(token) > 1])
-
-    # Record the total number of documents before filtering
+    # Tokenize all documents and count the tokens
+    tokens, indptr, indices, counts = build_document_term_counts(df['processed_text'])
     total_documents = len(df)
-
-    # Create a dictionary from the tokens of all documents and filter it
-    dictionary = corpora.Dictionary(df['tokens'])
-    pre_filter_tokens = {
-        dictionary[id]: freq for id, freq in dictionary.dfs.items()}
-    dictionary.filter_extremes(
-        no_below=min_token_frequency, no_above=no_above, keep_n=keep_n)
-
-    # Convert the token ID to word mapping into a more accessible format
-    # Accessing an item to "load" the dictionary
-    temp = dictionary[0]
-    id2word = dictionary.id2token
+    num_tokens = len(tokens)
+    document_frequencies = np.bincount(indices, minlength=num_tokens)
+
+    # Filter the tokens like gensim's filter_extremes: keep the tokens within the document frequency bounds,
+    # at most keep_n of them by document frequency, and renumber the kept tokens in their original order
+    no_above_abs = int(no_above * total_documents)
+    kept = (document_frequencies >= min_token_frequency) & (document_frequencies <= no_above_abs)
+    if keep_n is not None:
+        kept_ids = np.flatnonzero(kept)
+        kept_ids = kept_ids[np.argsort(-document_frequencies[kept_ids], kind='stable')][:keep_n]
+        kept = np.zeros(num_tokens, dtype=bool)
+        kept[kept_ids] = True
+    new_ids = np.cumsum(kept) - 1
+    id2word = {int(new_id): tokens[old_id] for new_id, old_id in enumerate(np.flatnonzero(kept))}
 
     # Filter documents based on the count of tokens that remain after filtering
-    df['token_count'] = df['tokens'].apply(lambda tokens: len(
-        [token for token in tokens if token in dictionary.token2id]))
-    df['unique_tokens'] = df['tokens'].apply(lambda tokens: list(dict.fromkeys(tokens)))
-    df['unique_token_count'] = df['unique_tokens'].apply(lambda tokens: len(
-        [token for token in tokens if token in dictionary.token2id]))
-
-
-    filtered_df = df[df['unique_token_count'] >= min_tokens_per_document].copy()
-
-    # Convert the filtered documents into a bag-of-words corpus
-    corpus = [dictionary.doc2bow(text) for text in filtered_df['tokens']]
+    documents = np.repeat(np.arange(total_documents), np.diff(indptr))
+    kept_entries = kept[indices]
+    df['token_count'] = np.bincount(documents[kept_entries], weights=counts[kept_entries],
+                                    minlength=total_documents).astype(np.int64)
+    df['unique_token_count'] = np.bincount(documents[kept_entries], minlength=total_documents)
+    kept_documents = df['unique_token_count'].to_numpy() >= min_tokens_per_document
+    filtered_df = df[kept_documents].copy()
+
+    # Convert the filtered documents into a bag-of-words corpus, a CSR matrix with one row per document
+    unique_token_counts = df['unique_token_count'].to_numpy()
+    matrix = scipy.sparse.csr_matrix(
+        (counts[kept_entries], new_ids[indices[kept_entries]].astype(np.int32),
+         np.concatenate(([0], np.cumsum(unique_token_counts)))),
+        shape=(total_documents, len(id2word)))[kept_documents]
+    matrix.sort_indices()
+    corpus = Sparse2Corpus(matrix, documents_columns=False)
 
     # Calculate the ratio of documents each token appears in after filtering
     remaining_tokens_ratio = {
-        token: dictionary.dfs[dictionary.token2id[token]] / total_documents for token in dictionary.token2id}
+        tokens[old_id]: document_frequencies[old_id] / total_documents for old_id in np.flatnonzero(kept)}
     remaining_tokens_ratio = sorted(
         remaining_tokens_ratio.items(), key=lambda x: x[1], reverse=True)
 
-    # Identify and calculate the document frequency ratio for tokens filtered out
-    filtered_out_tokens_ratio = {token: freq / total_documents for token,
-                                 freq in pre_filter_tokens.items() if token not in dictionary.token2id}
+    # Identify and calculate the document frequency ratio for tokens filtered out, in the order of their
+    # first occurrence in the corpus like the document frequencies of gensim's Dictionary
+    _, first_occurrences = np.unique(indices, return_index=True)
+    first_occurrence_order = np.argsort(first_occurrences, kind='stable')
+    filtered_out_tokens_ratio = {tokens[old_id]: document_frequencies[old_id] / total_documents
+                                 for old_id in first_occurrence_order if not kept[old_id]}
     filtered_out_tokens_ratio = sorted(
         filtered_out_tokens_ratio.items(), key=lambda x: x[1], reverse=True)
 
     return corpus, id2word, df, filtered_df, remaining_tokens_ratio, filtered_out_tokens_ratio
 
 
-def perform_topic_modeling(df, corpus, id2word, num_topics):
+def save_corpus(corpus, id2word, filtered_df, run_dir):
+    """
+    Saves the corpus of create_dictionary_and_corpus into the run directory for reuse: the document-term
+    matrix as corpus.npz (rows in the order of corpus_document_ids.json, columns in the order of
+    corpus_vocabulary.json).
+    """
+    scipy.sparse.save_npz(os.path.join(run_dir, 'corpus.npz'), corpus.sparse.T.tocsr())
+    with open(os.path.join(run_dir, 'corpus_vocabulary.json'), 'w') as file:
+        json.dump([id2word[token_id] for token_id in range(len(id2word))], file)
+    with open(os.path.join(run_dir, 'corpus_document_ids.json'), 'w') as file:
+        json.dump(filtered_df['id'].tolist(), file)
+
+
+def perform_topic_modeling(df, corpus, id2word, num_topics, engine=None):
     """
-    Perform topic modeling on a corpus using the NMF algorithm. 
+    Perform topic modeling on a corpus using the NMF algorithm of a topic model engine (see topic_model_engines).
     Stores the topic distribution for each document in the DataFrame as a list of scores.
 
     Parameters:
     - df (pandas.DataFrame): DataFrame containing the documents and their preprocessed text.
-    - corpus (list of list of (int, int)): The corpus to be modeled, as a bag-of-words.
-    - id2word (gensim.corpora.Dictionary): The dictionary mapping of ids to words.
+    - corpus (gensim.matutils.Sparse2Corpus): The corpus to be modeled, as a bag-of-words.
+    - id2word (dict): The mapping of ids to words.
     - num_topics (int): The number of topics to be generated by the NMF model.
+    - engine (str): Name of the topic model engine, by default TOPIC_MODEL_ENGINE.
 
     Returns:
-    - pandas.DataFrame: The original DataFrame with an additional column 'topic_distribution_nmf'
+    - The trained engine, with the training and inference time in its timings.
+    - pandas.DataFrame: The original DataFrame with an additional column 'topic_distribution'
                         containing the topic distribution as a list of scores for each document.
     """
 
-    # Initialize the NMF model
-    model = gensim.models.nmf.Nmf(corpus=corpus,
-                                  num_topics=num_topics,
-                                  id2word=id2word,
-                                  passes=10,
-                                  random_state=42,
-                                  w_max_iter=400,
-                                  w_stop_condition=0.00001,
-                                  h_max_iter=100,
-                                  h_stop_condition=0.0001)
-
-    # Generate topic distribution for the entire corpus
-    topic_distributions = [model.get_document_topics(
-        bow, minimum_probability=0) for bow in corpus]
-
-    # Convert topic distributions to lists of scores
-    topic_scores = []
-    for distribution in topic_distributions:
-        # Initialize a list of zeros for each topic
-        scores = [0] * num_topics
-        for topic_id, score in distribution:
-            scores[topic_id] = score
-        topic_scores.append(scores)
+    # Train the model and generate the topic distribution for the entire corpus in batches
+    model, topic_scores = topic_model_engines.train_and_infer(engine or config.settings.TOPIC_MODEL_ENGINE,
+                                                              corpus, id2word, num_topics,
+                                                              batch_size=TOPIC_MODEL_INFERENCE_BATCH_SIZE)
 
     # Assign the list of scores to the DataFrame
-    df['topic_distribution'] = topic_scores
-    df['most_relevant_topic'] = df['topic_distribution'].apply(
-        lambda scores: scores.index(max(scores)))
+    df['topic_distribution'] = topic_scores.tolist()
+    df['most_relevant_topic'] = topic_scores.argmax(axis=1)
 
     return model, df
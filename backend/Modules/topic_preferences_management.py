@@ -5,21 +5,26 @@ import numpy as np
 from Modules import database_queries,database
 from config.settings import num_topics_in_database
 from Modules.database_queries import es
+from Modules.user_context import UserContext
 np.float_ = np.float64
 
 
-def read_topic_preferences_of_user(user_id):
+def read_topic_preferences_of_user(user_id, user_context=None):
     """
     Retrieves the topic preferences for the given user ID.
 
     Parameters:
     - user_id (str): The unique identifier of the user.
+    - user_context (UserContext): Optional, already loaded user document to read from.
 
     Returns:
     - list: The list of topic preferences if found, otherwise None.
     """
-    # Call the get_user_by_id function from database_queries to fetch the user data
-    user_data = database.findByUserId(user_id)
+    if user_context is not None:
+        user_data = user_context.source
+    else:
+        # Call the get_user_by_id function from database_queries to fetch the user data
+        user_data = database.findByUserId(user_id)
 
     if user_data and 'topic_preferences' in user_data:
         # Extract and return the 'topic_preferences' field from the user data
@@ -51,20 +56,22 @@ def processed_topic_scores_from_topic_preferences(topic_preferences):
     return sorted_processed_scores
 
 
-def update_topic_preferences_from_processed_topic_scores(user_id):
+def update_topic_preferences_from_processed_topic_scores(user_id, user_context=None):
     """
     Read processed_topic_scores from the index 'users', calculate the new
     topic_preferences and upload it to the database.
+    If a UserContext is given, the scores are read from it and the new preferences are committed through it.
     """
     # Read new processed_topic_scores from index 'users'
     print(f'Reading processed_topic_scores')
     processed_topic_scores = None
     old_topic_preferences = None
     try:
-        response = es.get(index="users", id=user_id)
-        if response['found']:
-            processed_topic_scores =response['_source'].get('processed_topic_scores', None)
-            old_topic_preferences = response['_source'].get('topic_preferences', None)
+        if user_context is None:
+            user_context = UserContext.load(user_id)
+        if user_context is not None:
+            processed_topic_scores = user_context.get('processed_topic_scores', None)
+            old_topic_preferences = user_context.get('topic_preferences', None)
         else:
             print(f"User {user_id} not found.")      
     except Exception as e:
@@ -93,7 +100,7 @@ def update_topic_preferences_from_processed_topic_scores(user_id):
     # Normalize the new topic preferences to sum to 1
     print(processed_topic_scores)
     print(f'writing new topic_preferences')
-    database_queries.write_topic_preferences(user_id=user_id,
-                                             topic_preferences=new_topic_preferences)
+    user_context.set(topic_preferences=new_topic_preferences.tolist())
+    user_context.commit()
 
     return
\ No newline at end of file
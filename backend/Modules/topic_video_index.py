@@ -0,0 +1,149 @@
+import threading
+import time
+
+import numpy as np
+from elasticsearch.helpers import scan
+
+from Modules.database_queries import es
+from config.settings import TOPIC_VIDEO_INDEX_TTL_SECONDS
+
+
+class TopicVideoIndex:
+    """
+    In-memory copy of the 'videos_test' index for the candidate searches of the recommenders.
+
+    Every video gets an ordinal (its position in video_ids). For every topic, topic_ordinals holds the
+    ordinals of the videos whose most relevant topic it is, sorted by view count (descending).
+    Channels are numbered as well: channel_codes holds the code of the channel of every video
+    (-1 if unknown) and channel_ordinals the ordinals of the videos of every channel code.
+    """
+
+    def __init__(self, video_ids, view_counts, most_relevant_topics, channel_ids=None):
+        self.video_ids = list(video_ids)
+        self.ordinal_of = {video_id: ordinal for ordinal, video_id in enumerate(self.video_ids)}
+        self.view_counts = np.asarray(view_counts, dtype=np.int64)
+        self.most_relevant_topics = np.asarray(most_relevant_topics, dtype=np.int32)
+
+        if channel_ids is None:
+            channel_ids = [None] * len(self.video_ids)
+        self.channel_ids = sorted({channel_id for channel_id in channel_ids if channel_id})
+        self.channel_code_of = {channel_id: code for code, channel_id in enumerate(self.channel_ids)}
+        self.channel_codes = np.array([self.channel_code_of.get(channel_id, -1) for channel_id in channel_ids],
+                                      dtype=np.int32)
+        by_channel = np.argsort(self.channel_codes, kind='stable').astype(np.int32)
+        codes, starts = np.unique(self.channel_codes[by_channel], return_index=True)
+        ends = np.append(starts[1:], len(by_channel))
+        self.channel_ordinals = {int(code): by_channel[start:end]
+                                 for code, start, end in zip(codes, starts, ends) if code >= 0}
+
+        # Sort by topic, then by view count (descending) and ordinal, and cut the result into one slice per topic
+        ordinals = np.arange(len(self.video_ids), dtype=np.int32)
+        order = np.lexsort((ordinals, -self.view_counts, self.most_relevant_topics)).astype(np.int32)
+        topics, starts = np.unique(self.most_relevant_topics[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        self.topic_ordinals = {int(topic): order[start:end] for topic, start, end in zip(topics, starts, ends)}
+
+    def ordinals_of_channel(self, channel_id):
+        """
+        Returns the ordinals of the videos of the given channel (empty if the channel is unknown).
+        """
+        code = self.channel_code_of.get(channel_id)
+        if code is None:
+            return np.empty(0, dtype=np.int32)
+        return self.channel_ordinals[code]
+
+    def search(self, topics, excluded_ordinals):
+        """
+        Same result as rs_logic.seachTopic: the len(topics) most viewed videos whose most relevant topic is
+        one of the given topics, skipping the excluded ordinals.
+
+        :param topics: List of topic numbers, may contain duplicates.
+        :param excluded_ordinals: Ordinals of the videos to skip, any container such as a set or an exclusion_filter.OrdinalBitmap.
+        :return: List of ordinals, most viewed first.
+        """
+        size = len(topics)
+        candidates = []
+        for topic in set(topics):
+            # The first `size` non-excluded videos of every topic are enough to find the overall top `size`
+            taken = 0
+            for ordinal in self.topic_ordinals.get(int(topic), ()):
+                if ordinal in excluded_ordinals:
+                    continue
+                candidates.append(int(ordinal))
+                taken += 1
+                if taken == size:
+                    break
+        candidates.sort(key=lambda ordinal: (-self.view_counts[ordinal], ordinal))
+        return candidates[:size]
+
+    def search_response(self, topics, excluded_ordinals):
+        """
+        Runs search() and returns the result in the shape of the response to rs_logic.build_topic_query.
+        """
+        hits = [{
+            "_id": self.video_ids[ordinal],
+            "_source": {
+                "statistics": {"viewCount": int(self.view_counts[ordinal])},
+                "most_relevant_topic": int(self.most_relevant_topics[ordinal])
+            }
+        } for ordinal in self.search(topics, excluded_ordinals)]
+        return {"hits": {"hits": hits}}
+
+
+# Process-wide index, see get_index
+_index = None
+_loaded_at = 0.0
+_lock = threading.Lock()
+
+
+def _load_index(index_name='videos_test'):
+    """
+    Reads the most relevant topic and view count of every video of the index.
+    Videos without a most relevant topic can never be recommended and are skipped.
+    """
+    video_ids, view_counts, most_relevant_topics, channel_ids = [], [], [], []
+    query = {"query": {"exists": {"field": "most_relevant_topic"}}}
+    for hit in scan(client=es, index=index_name, query=query,
+                    _source=["statistics.viewCount", "most_relevant_topic", "snippet.channelId"]):
+        source = hit['_source']
+        video_ids.append(hit['_id'])
+        view_counts.append(int(source.get('statistics', {}).get('viewCount', 0)))
+        most_relevant_topics.append(int(source['most_relevant_topic']))
+        channel_ids.append(source.get('snippet', {}).get('channelId'))
+    print(f"Topic video index: loaded {len(video_ids)} videos from index '{index_name}'.")
+    return TopicVideoIndex(video_ids, view_counts, most_relevant_topics, channel_ids)
+
+
+def get_index():
+    """
+    Returns the cached topic video index, (re)loading it from Elasticsearch when it has not been loaded yet,
+    has been invalidated or is older than TOPIC_VIDEO_INDEX_TTL_SECONDS.
+
+    :return: A TopicVideoIndex, or None if it could not be loaded and the candidates have to be searched in Elasticsearch.
+    """
+    global _index, _loaded_at
+    index = _index
+    if index is not None and time.time() - _loaded_at < TOPIC_VIDEO_INDEX_TTL_SECONDS:
+        return index
+
+    with _lock:
+        # Another thread may have reloaded the index while we were waiting
+        if time.time() - _loaded_at >= TOPIC_VIDEO_INDEX_TTL_SECONDS:
+            try:
+                _index = _load_index()
+            except Exception as e:
+                # Keep serving the previous index (if any) and retry after the TTL
+                print(f"An error occurred while loading the topic video index: {e}")
+            _loaded_at = time.time()
+        return _index
+
+
+def invalidate():
+    """
+    Drops the cached index so that the next lookup reloads it from Elasticsearch.
+    Call this after the 'videos_test' index has been rewritten.
+    """
+    global _index, _loaded_at
+    with _lock:
+        _index = None
+        _loaded_at = 0.0
@@ -0,0 +1,103 @@
+from elasticsearch.exceptions import NotFoundError
+
+from Modules.database_queries import es, write_refresh
+
+
+def _as_document_value(value):
+    """
+    Converts a value to the shape it has when read back from Elasticsearch:
+    object keys become strings and NumPy arrays and scalars become plain lists and numbers.
+    """
+    if isinstance(value, dict):
+        return {str(key): _as_document_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_as_document_value(item) for item in value]
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
+
+
+class UserContext:
+    """
+    Request-scoped copy of a user's document from the 'users' index.
+
+    The document is read once when the context is loaded and then passed through the
+    recommender and feedback pipelines instead of re-reading it from Elasticsearch.
+    Changes are applied to the local copy right away and collected as pending mutations
+    until commit() writes them back in a single update.
+    """
+
+    def __init__(self, user_id, source, index_name='users'):
+        self.user_id = user_id
+        self.source = source
+        self.index_name = index_name
+        self.pending = {}
+
+    @classmethod
+    def load(cls, user_id, index_name='users'):
+        """
+        Reads the user document from Elasticsearch.
+
+        :param user_id: The ID of the user.
+        :param index_name: Name of the index containing the users.
+        :return: A UserContext, or None if the user does not exist.
+        """
+        try:
+            response = es.get(index=index_name, id=user_id)
+        except NotFoundError:
+            return None
+        return cls(user_id, response['_source'], index_name=index_name)
+
+    def get(self, field, default=None):
+        return self.source.get(field, default)
+
+    def set(self, **fields):
+        """
+        Sets the given fields on the local copy and marks them to be written on commit().
+        Fields are replaced as a whole, nested objects are not merged.
+        """
+        fields = {field: _as_document_value(value) for field, value in fields.items()}
+        self.source.update(fields)
+        self.pending.update(fields)
+
+    def commit(self):
+        """
+        Writes all pending mutations to the user document with a single update request.
+
+        :return: The result of the update ('updated', 'noop'), or None if there was nothing to write.
+        """
+        if not self.pending:
+            return None
+
+        response = es.update(index=self.index_name, id=self.user_id, body=self._commit_body(),
+                             retry_on_conflict=3, refresh=write_refresh())
+        self.pending = {}
+
+        return response['result']
+
+    async def commit_async(self, client):
+        """
+        Same as commit(), using the given AsyncElasticsearch client.
+        """
+        if not self.pending:
+            return None
+
+        response = await client.update(index=self.index_name, id=self.user_id, body=self._commit_body(),
+                                    retry_on_conflict=3, refresh=write_refresh())
+        self.pending = {}
+
+        return response['result']
+
+    def _commit_body(self):
+        # Other requests and background jobs may update the same user concurrently (see retry_on_conflict),
+        # only the pending fields are written.
+        # Replace the fields instead of using a partial doc, which would merge nested objects
+        # such as processed_topic_scores with their previous contents
+        script = {
+            "source": "for (entry in params.fields.entrySet()) { ctx._source[entry.getKey()] = entry.getValue(); }",
+            "lang": "painless",
+            "params": {
+                "fields": self.pending
+            }
+        }
+        return {"script": script}
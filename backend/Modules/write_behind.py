@@ -0,0 +1,122 @@
+import atexit
+import queue
+import threading
+import time
+
+from elasticsearch.helpers import bulk
+
+from Modules.database_queries import es
+
+
+class WriteBehindBuffer:
+    """
+    Bounded in-process queue of documents that are written to an Elasticsearch index in the background.
+
+    put() only enqueues the document. A flusher thread writes the queued documents with one _bulk
+    request whenever batch_size documents are waiting or flush_interval_seconds have passed.
+    When the queue is full, put() waits for at most put_timeout_seconds and then drops the document.
+    The counters keep track of enqueued, written, failed and dropped documents.
+    Documents still queued when the interpreter exits are written by an atexit hook, documents put after close()
+    are written synchronously.
+    """
+
+    def __init__(self, index_name, max_size=10000, batch_size=500, flush_interval_seconds=1.0, put_timeout_seconds=0):
+        self.index_name = index_name
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.put_timeout_seconds = put_timeout_seconds
+        self.queue = queue.Queue(maxsize=max_size)
+        self.counters = {'enqueued': 0, 'written': 0, 'failed': 0, 'dropped': 0}
+        self._counters_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'write-behind-{index_name}', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, document):
+        """
+        Enqueues a document to be written.
+
+        :return: True if the document was enqueued (or written, after close()), False if it was dropped because
+                 the queue is full.
+        """
+        if self._stopped.is_set():
+            # Nothing flushes the queue anymore, e.g. during interpreter shutdown
+            self._write_batch([document])
+            return True
+        try:
+            if self.put_timeout_seconds:
+                self.queue.put(document, timeout=self.put_timeout_seconds)
+            else:
+                self.queue.put_nowait(document)
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('enqueued')
+        if self._stopped.is_set():
+            # close() may have flushed the queue before this document arrived
+            self.flush()
+        return True
+
+    def flush(self):
+        """
+        Writes all currently queued documents.
+        """
+        while self._write_batch(self._take_batch(timeout=None)):
+            pass
+
+    def close(self):
+        """
+        Stops the flusher thread and writes the remaining documents.
+        """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._counters_lock:
+            stats = dict(self.counters)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+    def _count(self, counter, n=1):
+        with self._counters_lock:
+            self.counters[counter] += n
+
+    def _take_batch(self, timeout):
+        # Collect up to batch_size documents, waiting until the timeout for the first ones
+        batch = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(batch) < self.batch_size:
+            try:
+                if deadline is None:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch):
+        if not batch:
+            return False
+        actions = [{"_op_type": "index", "_index": self.index_name, "_source": document} for document in batch]
+        with self._write_lock:
+            try:
+                written, errors = bulk(es, actions, chunk_size=len(actions), raise_on_error=False)
+                self._count('written', written)
+                self._count('failed', len(errors))
+            except Exception as e:
+                print(f"An error occurred while writing {len(batch)} documents to '{self.index_name}': {e}")
+                self._count('failed', len(batch))
+        return True
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._write_batch(self._take_batch(timeout=self.flush_interval_seconds))
@@ -1,6 +1,8 @@
 from flask import Flask,request,jsonify
 import Modules.database as database
 import Modules.RecommenderEngine as recommenderEngine
+from Modules.user_context import UserContext
+from Modules import recommendation_enrichment
 import time
 import re
 from Modules.database_queries import es
@@ -37,101 +39,35 @@ def getRecommendations():
     if (userId==None):
         print("User {} does not logged in".format(userId))
         return "Not logged in",400
-    user=database.findByUserId(userId)
-    if(user != None):
-        recommenderEngine.invokeProcessFeedback(user)
-        recommendations=recommenderEngine.getRecommendations(userId)
+    userContext=UserContext.load(userId)
+    if(userContext != None):
+        # Serve the last committed profile, new feedbacks are processed in the background
+        recommenderEngine.scheduleProcessFeedback(userId)
+        recommendations=recommenderEngine.getRecommendations(userId, userContext)
         print(recommendations)
-        
-        mget_body = {
-            "docs": [
-                {
-                    "_id": recommendation["videoId"],  # Specify the fields you want to return here
-                }
-                for recommendation in recommendations
-            ]
-        }
 
-        response = es.mget(index="videos", body=mget_body)
-		
-        for recommendation,doc in zip(recommendations,response['docs']):
-            recommendation["video"]=doc['_source']
-
-        mget_body = {
-            "docs": [
-                {
-                    "_id": recommendation["videoId"],  # Specify the fields you want to return here
-                }
-                for recommendation in recommendations
-            ]
-        }
-
-        response = es.mget(index="topic_distributions", body=mget_body)
-		
-        for recommendation,doc in zip(recommendations,response['docs']):
-            topics=[]
-            for topicsScore in doc['_source']['most_relevant_topics']:
-                topic=database.findTopicById(topicsScore['topic_index'])
-                topics.append({
-                    "id":topicsScore['topic_index'],
-                    "description":topic['description'],
-                    "score":topicsScore['score']
-                })
-            recommendation["topics"]=topics
-            print(topics)
+        # Fetch video cards and topics of all recommendations in one round trip
+        recommendation_enrichment.enrich_recommendations(recommendations)
         return recommendations,200
     
     return "Error",400
 
-def addTopics(videoId):
-    topicDistribution = database.findtopicDistributionById(videoId)
-    if (topicDistribution!=None):
-        topics=topicDistribution["most_relevant_topics"]
-        topicResult=[]
-        mget_body = {
-            "docs": [
-                {
-                    "_id": topicScore["topic_index"],  # Specify the fields you want to return here
-                }
-                for topicScore in topics
-            ]
-        }
-
-        response = es.mget(index="topics", body=mget_body)
-        for doc in response['docs']:
-            topic=doc['_source']
-            topicResult.append({
-                    "score":topicScore["score"],
-                    "id":topic["topic_number"],
-		            "description":topic["description"]
-                })
-        return topicResult
-    return None
-
 @app.route("/videos/search", methods=['GET'])
 def searchVideos():
     keyword=request.args.get('keyword', None)
     page=request.args.get('page', None)
     videos=database.findVideoByKeyword(keyword,page)
     recommendations=[]
-    mget_body = {
-        "docs": [
-            {
-                "_id": recommendation["videoId"],  # Specify the fields you want to return here
-            }
-            for recommendation in recommendations
-        ]
-    }
-
-    response = es.mget(index="videos", body=mget_body)
-    for video,doc in zip(videos,response['docs']):
+    for video in videos:
         recommend={
             "videoId":video["id"],
             "explanation":"Search results",
-            "video":doc['_source'],
-            "topics":addTopics(video["id"])
+            "video":video
         }
         recommendations.append(recommend)
+
+    # The search already returned the videos, only their topics are missing
+    recommendation_enrichment.enrich_recommendations(recommendations, include_videos=False)
     return recommendations,200
  
 
@@ -170,12 +106,13 @@ def regiserUser():
 
 @app.route("/users/<userId>", methods=['GET','POST'])
 def getUser(userId):
-    user=database.findByUserId(userId)
-    if(user != None):
+    userContext=UserContext.load(userId)
+    if(userContext != None):
+        user=userContext.source
         if request.method == 'GET': 
-            recommenderEngine.invokeProcessFeedback(user)
+            # Serve the last committed profile, new feedbacks are processed in the background
+            recommenderEngine.scheduleProcessFeedback(userId)
             print("Loading User profile from database for user {}", user["userId"])
-            user=database.findByUserId(userId)
             print(user)
             userDTO = {
                 "userId":user["userId"],
@@ -201,17 +138,15 @@ def getUser(userId):
 
         if request.method == 'POST':
             newUser=request.get_json()
-            user["exploit_coeff"]=newUser["exploit_coeff"]
-            user["n_recs_per_model"]=newUser["n_recs_per_model"]
             topicDTOs=newUser["topic_preferences"]
             top10Topics={topicDTO["id"]:topicDTO["score"] for topicDTO in topicDTOs}
             print(top10Topics)
-            user["processed_topic_scores"]=top10Topics
-            res=database.saveUser(user)
-            try:
-                recommenderEngine.invokeUpdateModel(userId)
-            except Exception as e:
-                print(e)
+            userContext.set(exploit_coeff=newUser["exploit_coeff"],
+                            n_recs_per_model=newUser["n_recs_per_model"],
+                            processed_topic_scores=top10Topics)
+            # Committed after the profile jobs of the user that are already scheduled
+            res=recommenderEngine.scheduleCommit(userId, userContext).result()
+            recommenderEngine.scheduleUpdateModel(userId)
             print("User {} updated successfully!".format(userId))
             return "User updated successfully!",200
 
@@ -225,7 +160,7 @@ def saveFeedback():
     feedbacks=request.get_json()
     for feedback in feedbacks:
         feedback["id"]=feedback["userId"] + "_" + feedback["videoId"]
-        res=database.saveFeedback(feedback)
+    res=database.saveFeedbacks(feedbacks)
     print("Saved feedbacks")
     return "",200
 
@@ -0,0 +1,274 @@
+import asyncio
+import re
+import time
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import async_bulk, async_scan
+from quart import Quart, request, jsonify
+
+import Modules.database as database
+import Modules.RecommenderEngine as recommenderEngine
+from Modules import database_queries, exclusion_filter, recommendation_enrichment, rs_logic
+from Modules.user_context import UserContext
+
+# Asynchronous serving mode of backend.py: the same routes served by an ASGI app, e.g.
+#   hypercorn backend_asgi:app --bind 127.0.0.1:8081
+# Independent Elasticsearch calls of a request are sent concurrently with asyncio.gather,
+# the feedback and model update pipelines still run synchronously in a worker thread.
+
+app = Quart(__name__)
+
+# Setup the asynchronous connection to Elasticsearch
+async_es = AsyncElasticsearch(
+    database_queries.url,
+    basic_auth=(database_queries.username, database_queries.password)
+)
+
+
+async def loadUserContext(userId, index_name='users'):
+    try:
+        response = await async_es.get(index=index_name, id=userId)
+    except NotFoundError:
+        return None
+    return UserContext(userId, response['_source'], index_name=index_name)
+
+
+async def readExclusions(userContext):
+    # Videos the user gave feedback on and videos of disliked creators, cached across requests
+    exclusions = exclusion_filter.get_cached_exclusions(userContext.user_id)
+    attempts = 0
+    while exclusions is None:
+        attempts += 1
+        version = exclusion_filter.start_loading(userContext.user_id)
+        try:
+            watchedVideoIds = [entry['_source']['videoId'] async for entry in async_scan(
+                client=async_es,
+                index='feedback',
+                query=database_queries.build_feedback_by_user_query(userContext.user_id),
+            )]
+            dislikedVideoIds = database_queries.read_disliked_video_ids(userContext.user_id, user_context=userContext)
+        except Exception:
+            exclusion_filter.abandon_loading(userContext.user_id)
+            raise
+        # None if feedback was recorded during the scan, which may have missed it
+        exclusions = exclusion_filter.store_exclusions(userContext.user_id, watchedVideoIds, dislikedVideoIds,
+                                                       userContext.get('disliked_creators') or [], version=version,
+                                                       cache=attempts < exclusion_filter.MAX_LOAD_ATTEMPTS)
+    return exclusions
+
+
+async def searchCandidates(userContext, plan):
+    exclusions = await readExclusions(userContext)
+    # The in-memory index may have to be (re)loaded from Elasticsearch, which blocks
+    responses = await asyncio.to_thread(rs_logic.search_candidates_in_memory, plan, exclusions)
+    if responses is None:
+        response = await async_es.msearch(searches=rs_logic.build_candidate_searches(plan, list(exclusions.video_ids),
+                                                                                     list(exclusions.channel_ids)))
+        responses = response['responses']
+    return responses
+
+
+async def computeRecommendations(userContext):
+    try:
+        plan = rs_logic.plan_recommendations(userContext.user_id, userContext)
+        if plan['skip']:
+            await userContext.commit_async(async_es)
+            return []
+
+        # Store the newly recommended topics while the candidates are searched
+        _, responses = await asyncio.gather(
+            userContext.commit_async(async_es),
+            searchCandidates(userContext, plan)
+        )
+        return rs_logic.assemble_recommendations(plan, responses)
+    except Exception as e:
+        # Log the error for debugging purposes
+        print(e)
+    return None
+
+
+async def enrichRecommendations(recommendations, include_videos=True):
+    if not recommendations:
+        return recommendations
+    body = recommendation_enrichment.build_enrichment_request(
+        [recommendation["videoId"] for recommendation in recommendations], include_videos=include_videos)
+    response = await async_es.mget(body=body)
+    return recommendation_enrichment.apply_enrichment(recommendations, response, include_videos=include_videos)
+
+
+# topicController
+@app.route("/topics", methods=['GET'])
+async def getTopics():
+    return jsonify(await asyncio.to_thread(database.load_topics)), 200
+
+
+@app.route("/topics/<userId>", methods=['POST'])
+async def initializeTopics(userId):
+    topicIds=await request.get_json()
+    try:
+        print("Initializing topics {} for user: {}".format(topicIds, userId));
+        await asyncio.to_thread(recommenderEngine.regiserUser, userId, topicIds)
+    except:
+        print ("Error while initializing topics for user: {}, Deleted user: {}".format(userId,userId))
+        await async_es.delete(index='users', id=userId)
+        return "Error while initializing topics for user: " + userId + " Please try again later!",500
+    return "Topics initialized successfully for user: " + userId,200
+
+# LocalVideoController
+@app.route("/videos/recommendations", methods=['GET'])
+async def getRecommendations():
+    userId=request.args.get('userId', None)
+    if (userId==None):
+        print("User {} does not logged in".format(userId))
+        return "Not logged in",400
+    userContext=await loadUserContext(userId)
+    if(userContext != None):
+        # Serve the last committed profile, new feedbacks are processed in the background
+        recommenderEngine.scheduleProcessFeedback(userId)
+        recommendations=await computeRecommendations(userContext)
+        print(recommendations)
+
+        # Fetch video cards and topics of all recommendations in one round trip
+        await enrichRecommendations(recommendations)
+        return jsonify(recommendations),200
+
+    return "Error",400
+
+@app.route("/videos/search", methods=['GET'])
+async def searchVideos():
+    keyword=request.args.get('keyword', None)
+    page=request.args.get('page', None)
+    resp=await async_es.search(index='videos',from_=page,query=database.buildKeywordQuery(keyword),size=20)
+    recommendations=[]
+    for hit in resp['hits']['hits']:
+        video=hit['_source']
+        recommend={
+            "videoId":video["id"],
+            "explanation":"Search results",
+            "video":video
+        }
+        recommendations.append(recommend)
+
+    # The search already returned the videos, only their topics are missing
+    await enrichRecommendations(recommendations, include_videos=False)
+    return jsonify(recommendations),200
+
+
+# userController
+@app.route("/users/login", methods=['POST'])
+async def loginUser():
+    userId=(await request.get_json())["userId"]
+    print("User: {}".format(userId))
+    if (await async_es.exists(index='users', id=userId)):
+        return "Login successful!",200
+    return "User does not exist!",400
+
+
+@app.route("/users/register", methods=['POST'])
+async def regiserUser():
+    body=await request.get_json()
+    userId=body["userId"]
+    answers=body["answers"]
+    if (userId == None or userId==""):
+        print("User ID cannot be empty!")
+        return "User ID cannot be empty!",400
+    if (not re.match(r"^[a-zA-Z0-9]*$",userId)):
+        print("User ID can only contain alphanumeric characters!")
+        return "User ID can only contain alphanumeric characters!",400
+
+    if (not await async_es.exists(index='users', id=userId)):
+        user={
+            "feedbackLastUsed":int(time.time()),
+            "userId":userId,
+            "registrationDate":int(time.time()),
+            "answers":answers
+        }
+        await async_es.index(index='users', id=userId, body=user, refresh=database_queries.write_refresh())
+        print("User {} registered successfully!".format(userId))
+        return "Registration successful!",200
+    return "User already exists!",400
+
+@app.route("/users/<userId>", methods=['GET','POST'])
+async def getUser(userId):
+    userContext=await loadUserContext(userId)
+    if(userContext != None):
+        user=userContext.source
+        if request.method == 'GET':
+            # Serve the last committed profile, new feedbacks are processed in the background
+            recommenderEngine.scheduleProcessFeedback(userId)
+            print("Loading User profile from database for user {}", user["userId"])
+            print(user)
+            userDTO = {
+                "userId":user["userId"],
+                "n_recs_per_model":user["n_recs_per_model"],
+                "exploit_coeff":user["exploit_coeff"]
+            }
+
+            # find top 10 topics, served from the topic catalog
+            topics=await asyncio.to_thread(
+                lambda: [database.findTopicById(topicId) for topicId in user["processed_topic_scores"]])
+            top10TopicDto = []
+            for topic, score in zip(topics, user["processed_topic_scores"].values()):
+                topicDTO = {
+                    "score":score,
+                    "id":topic["topic_number"],
+                    "description":topic["description"]
+                }
+                top10TopicDto.append(topicDTO)
+
+            userDTO["topic_preferences"]=top10TopicDto
+            print("User {} retrieved successfully!".format(userId))
+            return jsonify(userDTO),200
+
+        if request.method == 'POST':
+            newUser=await request.get_json()
+            topicDTOs=newUser["topic_preferences"]
+            top10Topics={topicDTO["id"]:topicDTO["score"] for topicDTO in topicDTOs}
+            print(top10Topics)
+            userContext.set(exploit_coeff=newUser["exploit_coeff"],
+                            n_recs_per_model=newUser["n_recs_per_model"],
+                            processed_topic_scores=top10Topics)
+            # Committed after the profile jobs of the user that are already scheduled
+            res=await asyncio.wrap_future(recommenderEngine.scheduleCommit(userId, userContext))
+            recommenderEngine.scheduleUpdateModel(userId)
+            print("User {} updated successfully!".format(userId))
+            return "User updated successfully!",200
+
+
+    print("User {} does not exist!".format(userId))
+    return "User does not exist!",400
+
+#feedbackController
+@app.route("/feedback", methods=['POST'])
+async def saveFeedback():
+    feedbacks=await request.get_json()
+    for feedback in feedbacks:
+        feedback["id"]=feedback["userId"] + "_" + feedback["videoId"]
+    actions=database.buildFeedbackActions(feedbacks)
+    if actions:
+        await async_bulk(async_es, actions, chunk_size=len(actions), max_chunk_bytes=2**31-1,
+                         refresh=database_queries.write_refresh(searched=True))
+        database.addWatchedVideos(feedbacks)
+    print("Saved feedbacks")
+    return "",200
+
+#interactionController
+@app.route("/interactions", methods=['POST'])
+async def saveInteraction():
+
+    interactions=await request.get_json()
+    for interaction in interactions:
+        database.saveInteraction(interaction)
+    print("Saved feedbacks")
+    return "",200
+
+
+@app.after_serving
+async def closeElasticsearch():
+    # Write the interactions that are still buffered
+    await asyncio.to_thread(database.getInteractionBuffer().close)
+    await async_es.close()
+
+if __name__ == '__main__':
+    app.run(debug=True, port=8081)
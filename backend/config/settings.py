@@ -13,6 +13,21 @@ TOPIC_MODELING_DATA_DIR = os.path.join(DATA_DIR, 'topic_modeling')
 TOPIC_MODELING_RUNS_DIR = os.path.join(TOPIC_MODELING_DATA_DIR, 'runs')
 
 
+# Export of the corpus for topic modeling (see corpus_export)
+# True: sliced scroll of the 'videos' index to a partitioned Parquet dataset in CORPUS_EXPORT_DIR, with
+# CORPUS_EXPORT_SLICES slices read in parallel and the languages detected in CORPUS_EXPORT_LANGUAGE_WORKERS
+# processes (None: one per CPU). False: single scroll into memory (database_queries.get_entire_database)
+CORPUS_EXPORT_PARALLEL = True
+CORPUS_EXPORT_DIR = os.path.join(TOPIC_MODELING_DATA_DIR, 'corpus_export')
+CORPUS_EXPORT_SLICES = 4
+CORPUS_EXPORT_LANGUAGE_WORKERS = None
+
+# SQLite cache of the languages predicted for the videos, keyed by the content hash of title and description
+LANGUAGE_CACHE_PATH = os.path.join(TOPIC_MODELING_DATA_DIR, 'language_cache.sqlite')
+# SQLite cache of the processed texts of the videos, keyed by the content hash of combined text, languages and spaCy model
+TOKEN_CACHE_PATH = os.path.join(TOPIC_MODELING_DATA_DIR, 'token_cache.sqlite')
+
+
 # Function to create a directory for a new run
 def create_topic_modeling_run_dir(run_id):
     run_dir = os.path.join(TOPIC_MODELING_RUNS_DIR, run_id)
@@ -56,3 +71,90 @@ DATASETS = {
 
 # List of filtered out topics
 filtered_topics = [13, 16, 19, 21, 27, 28, 31, 37, 43, 44, 46, 50, 54, 59, 66, 67, 68, 75, 76, 78, 80, 81, 90, 92, 96, 99, 101, 102, 103, 105, 110, 114, 122, 124, 131, 132, 136, 141, 142, 146, 147, 148, 150, 152, 154, 156, 159, 164, 166, 171, 177, 180, 184, 186, 187, 196, 199, 201, 207, 215, 217, 218, 225, 232, 237, 256, 257, 263, 264, 266, 280, 282, 283, 284, 286, 287, 292, 293, 294, 296]
+
+# Topic catalog cache
+# Number of seconds the in-process copy of the 'topics' index is served before it is reloaded
+TOPIC_CATALOG_TTL_SECONDS = 15 * 60
+
+# Fields of the 'videos' index returned to the frontend with each recommendation
+VIDEO_CARD_FIELDS = ['id', 'snippet.title', 'snippet.description', 'snippet.channelId', 'snippet.channelTitle',
+                     'snippet.thumbnails', 'statistics', 'contentDetails.duration']
+
+# Visibility of single-document writes to searches
+# 'none': no refresh, writes become searchable with the next periodic refresh of the index
+# 'wait_for': each write waits until a periodic refresh has made it searchable (up to the refresh interval, ~1s)
+# 'immediate': each write refreshes the shards it touched
+# Users are always read with realtime GETs or from the in-request UserContext, which never need a refresh,
+# so user writes do not wait for one
+ES_WRITE_DURABILITY = 'none'
+# Writes that a later search must see: feedback, read back by the feedback scans of the recommenders
+ES_SEARCHED_WRITE_DURABILITY = 'wait_for'
+
+# Write-behind buffer of the 'interaction' index
+# Interactions are queued in-process and written with one _bulk request per batch of
+# INTERACTION_BUFFER_BATCH_SIZE or every INTERACTION_BUFFER_FLUSH_SECONDS.
+# When INTERACTION_BUFFER_MAX_SIZE interactions are queued, new ones wait for at most
+# INTERACTION_BUFFER_PUT_TIMEOUT_SECONDS (0: not at all) and are then dropped
+INTERACTION_BUFFER_MAX_SIZE = 10000
+INTERACTION_BUFFER_BATCH_SIZE = 500
+INTERACTION_BUFFER_FLUSH_SECONDS = 1.0
+INTERACTION_BUFFER_PUT_TIMEOUT_SECONDS = 0
+
+# Number of worker threads that process feedback and recompute the topic preferences of users in the background.
+# The jobs of one user always run on the same worker, in the order they were scheduled
+PROFILE_JOB_WORKERS = 4
+
+# Publishing of the topic distributions (see database_queries.publish_topic_distributions)
+# Number of threads and documents per request of the parallel bulk load of the new index
+PUBLISH_BULK_THREADS = 4
+PUBLISH_BULK_CHUNK_SIZE = 500
+
+# Adaptive bulk writer of the topic distributions of the videos (see bulk_writer.AdaptiveBulkWriter)
+# Number of bulk requests in flight, operations in the first request and the latency the batch size adapts to
+BULK_WRITER_WORKERS = 4
+BULK_WRITER_INITIAL_BATCH_SIZE = 500
+BULK_WRITER_TARGET_LATENCY_SECONDS = 1.0
+
+# In-memory topic video index
+# Serves the candidate searches of the recommenders from memory instead of Elasticsearch (False: always use Elasticsearch)
+TOPIC_VIDEO_INDEX_ENABLED = True
+# Number of seconds the index is served before it is reloaded from 'videos_test'
+TOPIC_VIDEO_INDEX_TTL_SECONDS = 15 * 60
+
+# In-memory percentile index
+# Serves the candidate search of the personalised RS from the percentile index of tm_run_in_database instead of
+# the nested queries on 'topic_distributions' (False: always use Elasticsearch)
+PERCENTILE_INDEX_ENABLED = True
+
+# Per-user exclusion cache
+# The videos a user must not be recommended (watched videos and videos of disliked creators) are read once and then
+# updated in-process as feedback arrives. Entries are rebuilt after EXCLUSION_CACHE_TTL_SECONDS, which bounds how long
+# feedback saved by another process can be missed
+EXCLUSION_CACHE_TTL_SECONDS = 5 * 60
+# Number of users whose exclusions are cached, least recently used users are evicted first
+EXCLUSION_CACHE_MAX_USERS = 10000
+
+# Similarity search of the topic-based RS
+# 'local': cosine similarity computed in-process from the similarity matrix of tm_run_in_database
+#          (falls back to Elasticsearch if the run has none)
+# 'elasticsearch': script_score query on the 'topic_distributions' index
+SIMILARITY_ENGINE = 'local'
+
+# Number of inverted lists of the ANN index searched by the local similarity engine. 0 searches all videos exactly.
+# On corpora of a few thousand videos the exact search is as fast as the ANN index and has full recall, so only set
+# this (e.g. 16) once ann_recall_report.json in the run directory shows a real latency gain at an acceptable recall.
+SIMILARITY_ANN_NPROBE = 0
+
+# Topic model engine of perform_topic_modeling (see topic_model_engines)
+# 'gensim': gensim's online NMF (single-threaded)
+# 'sklearn': scikit-learn's NMF on the sparse document-term matrix (multithreaded BLAS)
+TOPIC_MODEL_ENGINE = 'gensim'
+# Number of documents whose topic distributions are inferred at once
+TOPIC_MODEL_INFERENCE_BATCH_SIZE = 10000
+# Infer the topic distributions of the gensim engine in batches instead of per document with get_document_topics.
+# Much faster, but the scores differ slightly, since get_document_topics stops before the exact solution (on synthetic
+# corpora of 3k-20k documents: up to about 4e-3, most relevant topic changed for about 0.02% of the documents)
+TOPIC_MODEL_GENSIM_BATCHED_INFERENCE = False
+# Also train every engine on the corpus of the run and write their training and inference times to
+# topic_model_engine_benchmark.json in the run directory
+TOPIC_MODEL_BENCHMARK_ENGINES = False
@@ -4,10 +4,12 @@ sys.path.append('/Users/pablojerezarnau/git/RS-backend/')
 
 from Modules.helper_functions import format_duration
 import logging
-from Modules import topic_modeling, topic_modeling_file_management
+from Modules import topic_modeling, topic_modeling_file_management, similarity_engine, ann_index, language_cache, token_cache, topic_model_engines
 import os
+import json
 from datetime import datetime
 from config.settings import TOPIC_MODELING_PARAMS, create_topic_modeling_run_dir
+from config.settings import TOPIC_MODEL_ENGINE, TOPIC_MODEL_BENCHMARK_ENGINES, TOPIC_MODEL_INFERENCE_BATCH_SIZE
 import time
 from config.settings import TOPIC_MODELING_DATA_DIR, DATASETS, NUM_TOPICS_LIST, COMMON_TM_PARAMS
 import argparse
@@ -82,6 +84,10 @@ def main_workflow(dataset_key=None, num_topics=None, write_to_databse=False):
         logger.info("Step 1: Getting Textual Features")
         textual_features_df = topic_modeling.get_textual_features(data_path=data_path)
         end_time = time.time()  # End timing
+        cache_stats = language_cache.get_cache().stats()
+        if cache_stats['lookups']:
+            logger.info(f"Language cache: {cache_stats['hits']} of {cache_stats['lookups']} lookups were hits "
+                        f"({cache_stats['hit_rate']:.1%}), {cache_stats['misses']} languages detected.")
         logger.info(
             f"Completed Step 1 in {format_duration(end_time - start_time)}.")
 
@@ -91,6 +97,10 @@ def main_workflow(dataset_key=None, num_topics=None, write_to_databse=False):
         processed_df = topic_modeling.process_and_concatenate_textual_features(
             textual_features_df)
         end_time = time.time()  # End timing
+        cache_stats = token_cache.get_cache().stats()
+        if cache_stats['lookups']:
+            logger.info(f"Token cache: {cache_stats['hits']} of {cache_stats['lookups']} lookups were hits "
+                        f"({cache_stats['hit_rate']:.1%}).")
         logger.info(
             f"Completed Step 2 in {format_duration(end_time - start_time)}.")
 
@@ -106,6 +116,10 @@ def main_workflow(dataset_key=None, num_topics=None, write_to_databse=False):
         end_time = time.time()  # End timing
         logger.info(
             f"Completed Step 3 in {format_duration(end_time - start_time)}.")
+        logger.info(f"Corpus: {len(id2word)} tokens, {len(filtered_df)} documents.")
+
+        # write the corpus
+        topic_modeling.save_corpus(corpus, id2word, filtered_df, run_dir)
 
         # write textual features
         textual_features_df_path = os.path.join(
@@ -128,6 +142,18 @@ def main_workflow(dataset_key=None, num_topics=None, write_to_databse=False):
         end_time = time.time()  # End timing
         logger.info(
             f"Completed Step 4 in {format_duration(end_time - start_time)}.")
+        logger.info(f"Topic model engine '{TOPIC_MODEL_ENGINE}': training took "
+                    f"{model.timings['training_seconds']:.2f} s, inference took {model.timings['inference_seconds']:.2f} s.")
+
+        # Compare the training and inference times of all engines on this corpus
+        if TOPIC_MODEL_BENCHMARK_ENGINES:
+            benchmark = topic_model_engines.benchmark_engines(corpus, id2word, num_topics, trained_engine=model,
+                                                              batch_size=TOPIC_MODEL_INFERENCE_BATCH_SIZE)
+            for engine, timings in benchmark.items():
+                logger.info(f"Benchmark of '{engine}': training took {timings['training_seconds']:.2f} s, "
+                            f"inference took {timings['inference_seconds']:.2f} s.")
+            with open(os.path.join(run_dir, "topic_model_engine_benchmark.json"), 'w') as file:
+                json.dump(benchmark, file, indent=4)
 
         # Save a df of the video ids for which topic modeling was performed
         eligible_videos_path = os.path.join(run_dir, "eligible_videos.json")
@@ -137,6 +163,9 @@ def main_workflow(dataset_key=None, num_topics=None, write_to_databse=False):
         # Save topic distributions
         topic_modeling_file_management.save_topic_distributions(topic_modeling_df, run_dir)
 
+        # Save the matrix of the local similarity engine
+        similarity_engine.build_similarity_matrix(run_dir)
+
         # Save topic information
         topic_modeling_file_management.save_topics_with_document_counts_and_plot(topic_modeling_df=topic_modeling_df, model=model, run_dir=run_dir, tm_params=tm_params)
 
@@ -155,6 +184,17 @@ def main_workflow(dataset_key=None, num_topics=None, write_to_databse=False):
             logger.info(
                 f"Completed Step 5 in {format_duration(end_time - start_time)}.")
 
+        # Build the ANN index of the similarity engine and measure its recall against the exact search
+        start_time = time.time()  # Start timing
+        logger.info("Building the ANN index of the similarity engine")
+        ann_index.build_ann_index(run_dir)
+        recall_report = ann_index.write_recall_report(run_dir)
+        for nprobe, result in recall_report['nprobe'].items():
+            logger.info(f"nprobe={nprobe}: recall@{recall_report['k']}={result['recall']:.3f}, {result['latency_ms']:.2f} ms per query")
+        end_time = time.time()  # End timing
+        logger.info(
+            f"Built the ANN index in {format_duration(end_time - start_time)}.")
+
         logger.info("Workflow completed successfully.")
 
         # At the end of each workflow, remove handlers and close them